@@ -1,39 +1,191 @@
 #!/usr/bin/env python3
 
 # builtins
+import argparse
+import glob
 import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import logging
-import sys
+import time
 
 # my modules
 from mal_automaton.plex import PlexWebhook
 from mal_automaton.translate import tvdb_to_mal
+from mal_automaton.utils import loads
 
 
 log = logging.getLogger('mal_automaton')
 
 
 def load_webhook(path):
-    return PlexWebhook(json.load(path.expanduser().open()))
+    return PlexWebhook(loads(path.expanduser().read_bytes()))
 
 
-if __name__ == "__main__":
-    # try to run for all files passed in as arguments
-    if len(sys.argv) <= 1:
-        log.info("No webhooks given!")
-    else:
-        try:
-            for file in sys.argv[1:]:
-                webhook_path = Path(file).expanduser()
-
-                # load saved webhook and attempt to discern MAL id from the webhook
-                webhook = load_webhook(webhook_path)
-                results = tvdb_to_mal(webhook)
-                if results:
-                    log.info(f"MAL ID was determined to be: {results['mal_id']}")
+def expand(source):
+    """ Turn a file, directory or glob into the list of files it refers to. """
+    matches = sorted(glob.glob(str(Path(source).expanduser())))
+    paths = [Path(match) for match in matches] if matches else [Path(source).expanduser()]
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files += sorted(p for p in path.iterdir() if p.suffix in ('.json', '.jsonl'))
+        else:
+            files.append(path)
+    return files
+
+
+def iter_webhooks(sources):
+    """
+    Yield a (source, payload) tuple for every webhook in the given sources,
+    which can be files, directories or globs of saved webhooks, or JSONL files
+    with one webhook per line. Anything that can't be read is yielded with the
+    exception in place of the payload.
+    """
+    for source in sources:
+        for path in expand(source):
+            try:
+                if path.suffix == '.jsonl':
+                    with path.open() as fp:
+                        lines = [(f'{path}:{number}', line) for number, line in enumerate(fp, 1) if line.strip()]
                 else:
-                    log.info("No MAL equivalent found")
-        except Exception:
-            log.exception("Exception occurred.")
+                    lines = [(str(path), path.read_bytes())]
+            except Exception as e:
+                log.error(f"Couldn't read {path}: {e}")
+                yield str(path), e
+                continue
+            # a bad line only costs that one webhook, not the rest of the file
+            for where, raw in lines:
+                yield where, parse(where, raw)
+
+
+def parse(where, raw):
+    """ Decode one saved webhook, or return the exception if it isn't valid JSON. """
+    try:
+        return loads(raw)
+    except ValueError as e:
+        log.error(f"Couldn't read {where}: {e}")
+        return e
+
+
+def show_of(payload):
+    """ Key used to group webhooks for the same show together. """
+    if isinstance(payload, Exception):
+        return None
+    metadata = payload.get('Metadata') or {}
+    return metadata.get('grandparentGuid') or metadata.get('grandparentTitle')
+
+
+def process(source, payload):
+    """ Resolve a single webhook, returning a record of what happened. """
+    record = {'source': source, 'show': None, 'season': None, 'episode': None, 'result': None, 'error': None}
+    start = time.perf_counter()
+    try:
+        if isinstance(payload, Exception):
+            raise payload
+        webhook = PlexWebhook(payload)
+        record.update(show=webhook.media.series, season=webhook.media.season, episode=webhook.media.episode)
+        results = tvdb_to_mal(webhook)
+        if results:
+            log.info(f"MAL ID was determined to be: {results['mal_id']}")
+            record['result'] = results
+        else:
+            log.info("No MAL equivalent found")
+    except Exception as e:
+        log.exception(f"Exception occurred while processing {source}.")
+        record['error'] = f'{type(e).__name__}: {e}'
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+def process_group(items):
+    """ Process all the webhooks for one show, in order, so its franchise is only resolved once. """
+    return [process(source, payload) for source, payload in items]
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
 
+
+def summarize(records, elapsed):
+    latencies = sorted(record['seconds'] for record in records)
+    summary = {
+        'webhooks': len(records),
+        'matched': sum(1 for record in records if record['result']),
+        'unmatched': sum(1 for record in records if not record['result'] and not record['error']),
+        'errors': sum(1 for record in records if record['error']),
+        'seconds': elapsed,
+        'per_second': len(records) / elapsed if elapsed else 0.0,
+    }
+    if latencies:
+        summary.update(latency_mean=sum(latencies) / len(latencies), latency_p50=percentile(latencies, 0.5),
+                       latency_p95=percentile(latencies, 0.95), latency_max=latencies[-1])
+    return summary
+
+
+def run(sources, *, jobs=1, output=None):
+    """
+    Resolve every webhook in `sources`. Webhooks are grouped by show, and the
+    groups are processed on `jobs` threads. Returns the per-webhook records
+    and a summary. If `output` is given, the records are written to it as JSON
+    lines, and the summary next to it as '<output>.summary.json'.
+    """
+    groups = OrderedDict()
+    for source, payload in iter_webhooks(sources):
+        groups.setdefault(show_of(payload), []).append((source, payload))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        records = [record for group in pool.map(process_group, groups.values()) for record in group]
+    summary = summarize(records, time.perf_counter() - start)
+
+    if output:
+        with output.open('w') as fp:
+            for record in records:
+                fp.write(json.dumps(record) + '\n')
+        with output.with_name(output.name + '.summary.json').open('w') as fp:
+            json.dump(summary, fp, indent=4)
+    return records, summary
+
+
+def get_args():
+    parser = argparse.ArgumentParser(prog='mal_automaton')
+    parser.add_argument(
+        'webhooks',
+        nargs='*',
+        help='Saved webhooks: files, directories, globs, or JSONL files with one webhook per line',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='Number of shows to process at once',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='Write a JSON line per webhook with its result to this file',
+        type=lambda path: Path(path).expanduser(),
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if not args.webhooks:
+        log.info("No webhooks given!")
+        return
+
+    records, summary = run(args.webhooks, jobs=args.jobs, output=args.output)
+    log.info((f"Processed {summary['webhooks']} webhooks in {summary['seconds']:.1f}s "
+              f"({summary['per_second']:.2f}/s): {summary['matched']} matched, "
+              f"{summary['unmatched']} unmatched, {summary['errors']} errors."))
+    if records:
+        log.info((f"Latency: mean {summary['latency_mean']:.2f}s, p50 {summary['latency_p50']:.2f}s, "
+                  f"p95 {summary['latency_p95']:.2f}s, max {summary['latency_max']:.2f}s."))
+
+
+if __name__ == "__main__":
+    main()
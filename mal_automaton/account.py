@@ -3,17 +3,35 @@
 # builtins
 import logging
 import re
+import threading
+import time
 
 # 3rd party
 import requests
 
 # my modules
-from mal_automaton.animelist import AnimeList, WatchStatus
-from mal_automaton.utils import retry
+from mal_automaton import config
+from mal_automaton.animelist import AnimeList, AnimeListEntry, WatchStatus
+from mal_automaton.api import pooled_session
+from mal_automaton.cache import Cache
+from mal_automaton.mal import MAL_Series
+from mal_automaton.ratelimit import get_upstream
+from mal_automaton import write_behind
 
 
 log = logging.getLogger(__name__)
 
+_mal_config = config.get('mal') or {}
+# seconds before the list is checked for changes made elsewhere (e.g. on the website)
+LIST_REFRESH = _mal_config.get('list_refresh', 60 * 60)
+# logins (cookies and CSRF token) are kept in a file of their own, unless turned off
+REMEMBER_LOGIN = _mal_config.get('remember_login', True)
+SESSION_PATH = _mal_config.get('session_path', '~/.mal_automaton.session')
+
+
+class ConfigurationError(Exception):
+    """ An account can't be used the way it's configured, so trying again won't help. """
+
 
 class MAL_Account(object):
     """
@@ -24,29 +42,119 @@ class MAL_Account(object):
     MAL_Session object handles the raw MAL API transactions involved with
     making modifications to lists, and the Jikan object handles all the
     fetching of information from MAL.
+
+    Unless `write_behind` is off, changes to the list are made locally right
+    away, and sent to MAL in batches by a WriteBehind in front of the session.
+    The changes then return a Future of whether they went through, and the
+    local entry is rolled back to what MAL has if the change is given up on.
+    The local list is refreshed before an episode is marked as watched, if it
+    hasn't been for `LIST_REFRESH` seconds.
     """
-    def __init__(self, username, password=None):
+    def __init__(self, username, password=None, *, write_behind=write_behind.ENABLED):
         self.username = username
         self.password = password
+        self.write_behind = write_behind
+        self.user = None
+        self.writes = None
+        self._list_lock = threading.RLock()
+        # MAL ID -> the entry as it is on MAL (None if it isn't), for series with changes that haven't been sent
+        self._confirmed = {}
         if password:
-            self.user = MAL_Session(self.username, password)
+            self.add_password(password)
         else:
             log.warning(('No password given, modifications cannot be made to '
                          'your list until you call add_password().'))
         self.get_list()
 
-    @retry(tries=3)
     def get_list(self):
+        # retries are handled by the Jikan wrapper
         self.anime_list = AnimeList(self.username)
+        self._list_refreshed = time.monotonic()
+
+    def refresh_list(self, full=False):
+        """
+        Pick up changes made to the list elsewhere (see AnimeList.refresh()),
+        leaving alone the series with changes that haven't been sent yet.
+        """
+        with self._list_lock:
+            pending = self.writes.pending if self.writes is not None else {}
+            changes = self.anime_list.refresh(full, skip=pending)
+            self._list_refreshed = time.monotonic()
+        return changes
+
+    def _refresh_if_stale(self):
+        if time.monotonic() - self._list_refreshed >= LIST_REFRESH:
+            try:
+                self.refresh_list()
+            except Exception:
+                # the list we have is still good enough to go on with
+                log.exception(f'Failed to refresh the list of {self.username}.')
 
     def add_password(self, password):
+        self.close()
         self.user = MAL_Session(self.username, password)
+        if self.write_behind:
+            self.writes = write_behind.WriteBehind(self.user, on_settle=self._settled)
+            self.writes.start()
+
+    def close(self):
+        """ Send any list updates that are still waiting, returning the results of that last flush. """
+        results = {}
+        if self.writes is not None:
+            results = self.writes.close()
+            self.writes = None
+        return results
+
+    @property
+    def _writer(self):
+        # WriteBehind is falsy while nothing is pending
+        return self.writes if self.writes is not None else self.user
+
+    def _remember(self, mal_id):
+        """ Keep the entry as it is on MAL before the first change to it that hasn't been sent, to roll back to. """
+        if self.writes is not None and mal_id not in self._confirmed:
+            entry = self.anime_list.get(mal_id)
+            self._confirmed[mal_id] = entry.copy() if entry is not None else None
+
+    def _settled(self, mal_id, write, written):
+        """ Called by the WriteBehind once a change has gone through, or has been given up on. """
+        with self._list_lock:
+            if not written:
+                self._roll_back(mal_id)
+            elif self.writes is not None and mal_id in self.writes.pending:
+                # there's more to send, which would now be rolled back to this
+                self._confirmed[mal_id] = self._entry_after(mal_id, write)
+            else:
+                self._confirmed.pop(mal_id, None)
+
+    def _roll_back(self, mal_id):
+        if mal_id not in self._confirmed:
+            # e.g. recovered from the journal, in which case the list was loaded from MAL since
+            return
+        entry = self._confirmed.pop(mal_id)
+        log.warning(f'Update for {mal_id} never made it to MAL, rolling the local list of {self.username} back.')
+        if entry is None:
+            self.anime_list.remove(mal_id)
+        else:
+            self.anime_list.add(entry)
+
+    def _entry_after(self, mal_id, write):
+        """ The entry as it is on MAL once `write` has gone through. """
+        if write['action'] == 'delete':
+            return None
+        status = WatchStatus(write['status'])
+        entry = self._confirmed.get(mal_id) or self.anime_list.get(mal_id)
+        entry = entry.copy() if entry is not None else AnimeListEntry.from_series(MAL_Series(mal_id), status)
+        entry.status.watching = status
+        entry.status.score = write['score']
+        entry.status.watched_episodes = write['watched_episodes']
+        return entry
 
     def needs_auth(func):
         def wrapper(self, *args, **kwargs):
             if not self.user:
-                raise Exception('You need to be authenticated to do this.')
-            return func(*args, **kwargs)
+                raise ConfigurationError('You need to be authenticated to do this.')
+            return func(self, *args, **kwargs)
         return wrapper
 
     @property
@@ -54,14 +162,30 @@ class MAL_Account(object):
         return [i.title for i in self.anime_list.entries.values()]
 
     @needs_auth
-    def add_series(self, mal_id):
-        return self.user.add_series(mal_id)
+    def add_series(self, mal_id, status=WatchStatus.PlanToWatch, score=0, watched_episodes=0):
+        with self._list_lock:
+            self._remember(mal_id)
+            updated = self._writer.add_series(mal_id, status=status, score=score, watched_episodes=watched_episodes)
+            if updated:
+                # keep the local list in step, instead of fetching it again
+                self.anime_list.add(AnimeListEntry.from_series(MAL_Series(mal_id), status, score, watched_episodes))
+        return updated
+
+    @needs_auth
+    def edit_series(self, mal_id, status, score, watched_episodes):
+        with self._list_lock:
+            self._remember(mal_id)
+            updated = self._writer.edit_series(mal_id, status, score, watched_episodes)
+            if updated and mal_id in self.anime_list:
+                self.anime_list.set_status(mal_id, status, score=score, watched_episodes=watched_episodes)
+        return updated
 
     @needs_auth
     def watch_episode(self, mal_id, episode):
+        self._refresh_if_stale()
         # if we aren't already watching the anime, add it and mark as watching
         if mal_id not in self.anime_list:
-            return self.user.add_series(mal_id, status=WatchStatus.Watching, num_watched_episodes=episode)
+            return self.add_series(mal_id, status=WatchStatus.Watching, watched_episodes=episode)
 
         # else, get the current status of the anime in question
         anime = self.anime_list[mal_id]
@@ -71,23 +195,93 @@ class MAL_Account(object):
         watched_new_episode = episode > status.watched_episodes
 
         if watched_new_episode:
-            # update the local list
-            status.watched_episodes = episode
-
-            # if it was the last episode
-            if episode >= anime.total_episodes:
+            # if it was the last episode (the total is 0 while it isn't known yet)
+            if anime.total_episodes and episode >= anime.total_episodes:
                 # mark as complete
-                return self.user.edit_series(mal_id, WatchStatus.Completed, status.score, episode)
+                return self.edit_series(mal_id, WatchStatus.Completed, status.score, episode)
             else:
                 # mark as watching and change episode
-                return self.user.edit_series(mal_id, WatchStatus.Watching, status.score, episode)
+                return self.edit_series(mal_id, WatchStatus.Watching, status.score, episode)
         else:
             # return None if we don't update anything
             return None
 
     @needs_auth
     def remove_series(self, mal_id):
-        return self.user.delete_series(mal_id)
+        with self._list_lock:
+            self._remember(mal_id)
+            updated = self._writer.delete_series(mal_id)
+            if updated:
+                self.anime_list.remove(mal_id)
+        return updated
+
+
+class AccountPool(object):
+    """
+    The MAL accounts that webhooks are applied to, picked by the Plex user
+    the webhook is from. `credentials` maps Plex user IDs to a dict with the
+    MAL username and password, and `default` (if given) is used for any Plex
+    user not in it. Accounts are only set up when they're first needed, and
+    Plex users with the same MAL username share an account. Every account
+    has its own session and write-behind queue, but they all share the same
+    connection pool and caches.
+    """
+    def __init__(self, credentials, default=None):
+        self.credentials = {str(plex_id): creds for plex_id, creds in credentials.items()}
+        self.default = default
+        self._accounts = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, plex_user_id):
+        """
+        The MAL account for a Plex user, or None if they don't have one.
+        Raises ConfigurationError if their account has no password.
+        """
+        creds = self.credentials.get(str(plex_user_id)) or self.default
+        if not creds or not creds.get('username'):
+            return None
+        username = creds['username']
+        if not creds.get('password'):
+            raise ConfigurationError(f'No password configured for MAL account {username}.')
+        # only one thread sets up each account, without holding up the others
+        with self._lock:
+            lock = self._locks.setdefault(username, threading.Lock())
+        with lock:
+            if username not in self._accounts:
+                log.info(f'Setting up MAL account {username}.')
+                self._accounts[username] = MAL_Account(username, creds.get('password'))
+            return self._accounts[username]
+
+    def close(self):
+        """ Close every account, returning the results of their last flushes by username. """
+        with self._lock:
+            accounts = dict(self._accounts)
+        return {username: account.close() for username, account in accounts.items()}
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def __repr__(self):
+        return f'<AccountPool: {len(self)} accounts>'
+
+
+_sessions = None
+_sessions_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    Return the process-wide store MAL logins are kept in, creating it on
+    first use. It's a file only the current user can read, separate from the
+    other caches, or just memory if logins aren't to be remembered.
+    """
+    global _sessions
+    with _sessions_lock:
+        if _sessions is None:
+            _sessions = Cache(SESSION_PATH if REMEMBER_LOGIN else ':memory:', 'mal_sessions',
+                              max_entries=None, private=True)
+        return _sessions
 
 
 class MAL_Session(object):
@@ -97,6 +291,11 @@ class MAL_Session(object):
     information from a list, use a Jikan() instance instead (Or if you want to
     do both, use the MAL_Account class, which utilizes instances of both Jikan
     and MAL_Session)
+
+    The cookies and CSRF token are kept in the session store (see
+    get_session_store()), and reused by later sessions for the same user.
+    Logging in only happens when there's nothing to reuse, or MAL turns a
+    write down as unauthenticated.
     """
     headers = {
         'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
@@ -104,26 +303,87 @@ class MAL_Session(object):
                        '(KHTML, like Gecko) Chrome/77.0.3865.120 Safari/537.36'),
     }
 
+    login_url = 'https://myanimelist.net/login.php'
+
     def __init__(self, username, password):
         self.username = username
         self.password = password
-        self.session = requests.Session()
-        self.login()
+        # a session of our own for the cookies, but connections come from the shared pool
+        self.session = pooled_session()
+        self.csrf_token = None
+        # reuse the last login if we have it, otherwise we log in on the first write
+        self._restore()
+
+    def _restore(self):
+        saved = get_session_store().get(self.username)
+        if saved is None:
+            return
+        for cookie in saved['cookies']:
+            self.session.cookies.set_cookie(requests.cookies.create_cookie(**cookie))
+        self.csrf_token = saved['csrf_token']
+        log.debug(f'Restored MAL session for {self.username}.')
+
+    def _save(self):
+        """ Keep the cookies and CSRF token, so later runs don't have to log in again. """
+        cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path,
+                    'expires': c.expires, 'secure': c.secure} for c in self.session.cookies]
+        get_session_store().set(self.username, {'cookies': cookies, 'csrf_token': self.csrf_token})
+
+    def _get(self, url, **kwargs):
+        """ GET from MAL through the shared rate limiter, retrying if MAL is struggling. """
+        return get_upstream('mal').call(self.session.get, url, **kwargs)
+
+    def _post(self, url, data, *, idempotent=True, **kwargs):
+        """ POST to MAL through the shared rate limiter, retrying if MAL is struggling (and it's safe to). """
+        return get_upstream('mal').call(self.session.post, url, data=data, headers=self.headers,
+                                        idempotent=idempotent, **kwargs)
+
+    @staticmethod
+    def _find_csrf(html):
+        match = re.search(r"<meta name='csrf_token' content='(.*?)'>", html)
+        return match.group(1) if match else None
 
     def login(self):
-        mal_login = 'https://myanimelist.net/login.php'
-
         # grab the csrf_token
-        prefetch = self.session.get(mal_login)
-        csrf_regex = r"<meta name='csrf_token' content='(.*?)'>"
-        match = re.search(csrf_regex, prefetch.text)
-        if not match:
+        self.session.cookies.clear()
+        prefetch = self._get(self.login_url)
+        self.csrf_token = self._find_csrf(prefetch.text)
+        if not self.csrf_token:
             raise Exception('No CSRF token found')
-        self.csrf_token = match.groups(0)
 
         # actually log in
-        resp = self.session.post(mal_login, headers=self.headers, data=self.login_data)
-        return (resp.url == 'https://myanimelist.net')
+        resp = self._post(self.login_url, self.login_data)
+        logged_in = resp.ok and 'login.php' not in resp.url
+        if logged_in:
+            # the page we land on has the token for the logged in session
+            self.csrf_token = self._find_csrf(resp.text) or self.csrf_token
+            self._save()
+        else:
+            log.warning(f'Failed to log in to MAL as {self.username}.')
+        return logged_in
+
+    @staticmethod
+    def _rejected(resp):
+        """ Whether MAL turned a write down because we aren't logged in, or the CSRF token is stale. """
+        if resp.status_code in (401, 403) or 'login.php' in resp.url:
+            return True
+        return resp.status_code == 400 and 'csrf' in resp.text.lower()
+
+    def _write(self, url, data, *, idempotent=True):
+        """
+        Make a change to the list, logging in (again) first if MAL wants us
+        to. Changes that would be applied twice if they were repeated aren't
+        retried when MAL fails, since it might have made them anyway.
+        """
+        if self.csrf_token is None:
+            self.login()
+        resp = self._post(url, dict(data, csrf=self.csrf_token), idempotent=idempotent)
+        if self._rejected(resp):
+            # turned down before anything was changed, so this is always safe
+            log.info(f'MAL session for {self.username} has expired, logging in again.')
+            if self.login():
+                resp = self._post(url, dict(data, csrf=self.csrf_token), idempotent=idempotent)
+        return resp.ok
 
     @property
     def login_data(self):
@@ -140,33 +400,24 @@ class MAL_Session(object):
     def add_series(self, mal_id, status=WatchStatus.PlanToWatch, score=0, watched_episodes=0):
         url = 'https://myanimelist.net/ownlist/anime/add.json'
         data = {
-            'csrf': self.csrf_token,
             'anime_id': mal_id,
-            'status': int(status),
+            'status': status.value,
             'score': score,
             'num_watched_episodes': watched_episodes
         }
-
-        resp = self.session.post(url, data=data, headers=self.headers)
-        return resp.ok
+        # adding twice would put the series on the list twice
+        return self._write(url, data, idempotent=False)
 
     def edit_series(self, mal_id, status=WatchStatus.Watching, score=0, watched_episodes=0):
         url = 'https://myanimelist.net/ownlist/anime/edit.json'
         data = {
-            'csrf': self.csrf_token,
             'anime_id': mal_id,
-            'status': int(status),
+            'status': status.value,
             'score': score,
             'num_watched_episodes': watched_episodes
         }
-
-        resp = self.session.post(url, data=data, headers=self.headers)
-        return resp.ok
+        return self._write(url, data)
 
     def delete_series(self, mal_id):
         url = f'https://myanimelist.net/ownlist/anime/{mal_id}/delete'
-        data = {'csrf': self.csrf_token}
-
-        resp = self.session.post(url, data=data, headers=self.headers)
-        return resp.ok
-
+        return self._write(url, {})
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Awaitable versions of the main entry points, so that many webhooks can be
+resolved concurrently on one event loop.
+
+Jikan is talked to through one pooled aiohttp session per event loop.
+Responses are written to the same response cache the synchronous wrappers
+read from (from the loop's executor, since it's SQLite underneath), so the
+awaitables prefetch everything they need concurrently, and then build the
+usual (memoized) objects off the loop from the warm cache. TVDB is reached
+through tvdbsimple, which only does blocking requests, so it's run in the
+loop's executor instead.
+
+Work done with this module should be wrapped in `async with session():`,
+which closes the loop's Jikan session at the end.
+"""
+
+# builtins
+import asyncio
+import logging
+import weakref
+from contextlib import asynccontextmanager
+from functools import partial
+
+# 3rd party
+import aiohttp
+from jikanpy import AioJikan
+
+# my modules
+from mal_automaton import config, translate
+from mal_automaton.api import TTL, CONNECTIONS, anime_ttl
+from mal_automaton.cache import get_cache, get_name_cache, cache_key
+from mal_automaton.mal import MAL_Series, MAL_Franchise
+from mal_automaton.ratelimit import get_upstream
+from mal_automaton.tvdb import TVDB_Series
+
+
+log = logging.getLogger(__name__)
+
+_cache_config = config.get('cache') or {}
+
+
+class AsyncCachedJikan(object):
+    """
+    Async counterpart of CachedJikan, sharing its response cache, keys and
+    TTLs. All requests go through one aiohttp session, which keeps at most
+    `connections` keep-alive connections open. Concurrent requests for the
+    same response are only sent once. The session and the requests in flight
+    belong to the event loop they were made on, so an instance can only be
+    used from one loop (see get_async_jikan()).
+    """
+    def __init__(self, cache=None, *, connections=CONNECTIONS, session=None):
+        self.cache = cache
+        self.connections = connections
+        self._session = session
+        self._jikan = None
+        self._in_flight = {}
+
+    async def _client(self):
+        # the session has to be created while the loop is running
+        if self._jikan is None:
+            if self._session is None:
+                connector = aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=30)
+                self._session = aiohttp.ClientSession(connector=connector)
+            self._jikan = AioJikan(session=self._session)
+        return self._jikan
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        self._session = self._jikan = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *excinfo):
+        await self.close()
+
+    async def anime(self, id, extension=None, page=None):
+        key = cache_key('anime', id, extension, page)
+        return await self._cached(key, lambda resp: anime_ttl(self.cache, id, resp),
+                                  'anime', id, extension=extension, page=page)
+
+    async def search(self, search_type, query, page=None, parameters=None):
+        key = cache_key('search', search_type, query.casefold(), page, parameters and sorted(parameters.items()))
+        return await self._cached(key, lambda resp: TTL['search'],
+                                  'search', search_type, query, page=page, parameters=parameters)
+
+    async def user(self, username, request=None, argument=None, page=None, parameters=None):
+        key = cache_key('user', username.casefold(), request, argument, page, parameters and sorted(parameters.items()))
+        return await self._cached(key, lambda resp: TTL['user'],
+                                  'user', username=username, request=request, argument=argument,
+                                  page=page, parameters=parameters)
+
+    async def _cached(self, key, ttl, method, *args, **kwargs):
+        if self.cache is not None and key not in self._in_flight:
+            resp = await run_sync(self.cache.get, key)
+            if resp is not None:
+                log.debug(f'Response cache hit for {key}')
+                resp['request_cached'] = True
+                return resp
+
+        # if someone is already fetching this, wait for their response instead
+        if key not in self._in_flight:
+            log.debug(f'Response cache miss for {key}')
+            self._in_flight[key] = asyncio.ensure_future(self._fetch(key, ttl, method, *args, **kwargs))
+        return await asyncio.shield(self._in_flight[key])
+
+    async def _fetch(self, key, ttl, method, *args, **kwargs):
+        try:
+            jikan = await self._client()
+            # shares the rate limit with the synchronous wrapper
+            resp = await get_upstream('jikan').call_async(getattr(jikan, method), *args, **kwargs)
+            if self.cache is not None:
+                await run_sync(self._store, key, resp, ttl)
+            return resp
+        finally:
+            self._in_flight.pop(key, None)
+
+    def _store(self, key, resp, ttl):
+        # working out the TTL can read the cache too
+        self.cache.set(key, resp, ttl=ttl(resp))
+
+
+# event loop -> AsyncCachedJikan, so a loop that's gone doesn't keep its client around
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_jikan():
+    """ Return the AsyncCachedJikan for the running event loop, creating it on first use. """
+    loop = asyncio.get_running_loop()
+    jikan = _clients.get(loop)
+    if jikan is None:
+        jikan = AsyncCachedJikan(get_cache('responses') if _cache_config.get('enabled', True) else None)
+        _clients[loop] = jikan
+    return jikan
+
+
+@asynccontextmanager
+async def session():
+    """ Use the running loop's AsyncCachedJikan, and close its session on the way out. """
+    try:
+        yield get_async_jikan()
+    finally:
+        jikan = _clients.pop(asyncio.get_running_loop(), None)
+        if jikan is not None:
+            await jikan.close()
+
+
+async def run_sync(func, *args, **kwargs):
+    """ Run a blocking call in the loop's default executor. """
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+def _related_id(details, relation):
+    try:
+        return details['related'].get(relation)[0]['mal_id']
+    except TypeError:
+        return None
+
+
+async def resolve_name(name):
+    """ Awaitable version of looking up a MAL ID by name (raises IndexError if nothing is found). """
+    names = get_name_cache('mal')
+    mal_id = await run_sync(names.get, name)
+    if mal_id is None:
+        mal_id = (await get_async_jikan().search('anime', name))['results'][0]['mal_id']
+        await run_sync(names.set, name, mal_id)
+    return mal_id
+
+
+async def prefetch_episodes(id):
+    """ Fetch every page of episodes for a series, all pages after the first at once. """
+    jikan = get_async_jikan()
+    first = await jikan.anime(id, extension='episodes')
+    pages = range(2, first['episodes_last_page'] + 1)
+    await asyncio.gather(*(jikan.anime(id, extension='episodes', page=page) for page in pages))
+
+
+async def prefetch_franchise(id):
+    """ Fetch the details of a series and every prequel and sequel of it, walking both ways at once. """
+    jikan = get_async_jikan()
+
+    async def walk(id, relation):
+        while id:
+            id = _related_id(await jikan.anime(id), relation)
+
+    details = await jikan.anime(id)
+    await asyncio.gather(walk(_related_id(details, 'Prequel'), 'Prequel'),
+                         walk(_related_id(details, 'Sequel'), 'Sequel'))
+
+
+async def series(id=None, *, name=None, episodes=False):
+    """ Awaitable MAL_Series(). With `episodes`, its episodes are fetched up front too. """
+    id = id or await resolve_name(name)
+    await asyncio.gather(get_async_jikan().anime(id), *([prefetch_episodes(id)] if episodes else []))
+    return await run_sync(MAL_Series, id)
+
+
+async def franchise(id=None, *, name=None):
+    """ Awaitable MAL_Franchise(). Episodes are still only fetched when they're needed. """
+    id = id or await resolve_name(name)
+    await prefetch_franchise(id)
+    return await run_sync(MAL_Franchise, id)
+
+
+async def tvdb_series(id=None, *, name=None):
+    """ Awaitable TVDB_Series(). """
+    return await run_sync(TVDB_Series, id, name=name)
+
+
+async def _prefetch_match(media):
+    """
+    Warm the response cache with everything matching this episode is likely
+    to need: the TVDB episode and the MAL franchise are looked up at the same
+    time, then the episodes of every series that could have aired it.
+    """
+    airdate, found = await asyncio.gather(run_sync(lambda: media.airdate), franchise(name=media.series))
+    candidates = [s for s in found.series if airdate is None or s.might_have_aired(airdate)]
+    await asyncio.gather(*(prefetch_episodes(s.id) for s in candidates))
+
+
+async def tvdb_to_mal(webhook):
+    """
+    Awaitable translate.tvdb_to_mal(). Nothing is fetched for webhooks that
+    can be answered (or skipped) without going out to the APIs.
+    """
+    media = webhook.media
+    answered = await run_sync(lambda: translate.cached_miss(media) or translate.cached_mapping(media))
+    if translate.library_allowed(media) and not answered:
+        try:
+            await _prefetch_match(media)
+        except Exception as e:
+            # tvdb_to_mal() does it all again, and deals with the failure properly
+            log.debug(f"Couldn't prefetch '{media.title}': {e}")
+    return await run_sync(translate.tvdb_to_mal, webhook)
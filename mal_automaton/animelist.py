@@ -1,74 +1,166 @@
 #!/usr/bin/env python3
 
 # builtins
+import copy
 import logging
+from collections import Counter
 
 # 3rd party
-from jikanpy import Jikan
 # from jikanpy.exceptions import APIException
 
 # my modules
+from mal_automaton.api import get_jikan
 from mal_automaton.mal import MAL_Series
 from mal_automaton.enums import AnimeType, AiringStatus, WatchStatus
 
 
 log = logging.getLogger(__name__)
 
+# entries per page of a user's list on Jikan; a shorter page is the last one
+PAGE_SIZE = 300
+# order used by quick refreshes, so the entries that changed come first
+RECENTLY_UPDATED = {'order_by': 'last_updated', 'sort': 'descending'}
+
 
 class AnimeList(object):
+    """
+    A user's anime list, indexed by MAL ID. Entries are also kept in a
+    partition per WatchStatus, so membership, lookups and the status views
+    are all dictionary operations that never go out to the network. Entry
+    changes have to go through set_status() to keep the partitions right.
+    """
     def __init__(self, username):
         self.user = username
-        self._api = Jikan()
+        self._api = get_jikan()
+        self.entries = {}
+        self._by_status = {status: {} for status in WatchStatus}
         self.update()
 
     def update(self):
-        _list = self._api.user(username=self.user, request='animelist')['anime']
-        self._list = [AnimeListEntry(i) for i in _list]
+        """ Load the whole list (a recently cached copy will do). """
+        return self.refresh(full=True, fresh=False)
+
+    def pages(self, parameters=None, fresh=False):
+        """ Stream the user's list from Jikan, one page of raw entries at a time. """
+        page = 1
+        while True:
+            entries = self._api.user(username=self.user, request='animelist', argument='all',
+                                     page=page, parameters=parameters, fresh=fresh)['anime']
+            if entries:
+                yield entries
+            if len(entries) < PAGE_SIZE:
+                return
+            page += 1
+
+    def refresh(self, full=False, *, fresh=True, skip=()):
+        """
+        Bring the list up to date, only touching the entries that changed.
+        A quick refresh goes through the list most recently updated first, and
+        stops at the first page without any changes, so it can't notice
+        entries that were removed. A full refresh goes through every page, and
+        drops anything that's no longer on the list. Returns a Counter of the
+        entries that were added, changed and removed.
+
+        The list is fetched `fresh` by default, since a cached copy could be
+        older than changes that were written through since. Entries in `skip`
+        (e.g. with changes that haven't been sent to MAL yet) are left alone.
+        """
+        changes = Counter(added=0, changed=0, removed=0)
+        seen = set(skip)
+        for page in self.pages(None if full else RECENTLY_UPDATED, fresh):
+            page_changes = Counter(self._apply(data) for data in page if data['mal_id'] not in skip)
+            page_changes.pop(None, None)
+            changes.update(page_changes)
+            seen.update(data['mal_id'] for data in page)
+            if not full and not page_changes:
+                break
+        if full:
+            for mal_id in set(self.entries) - seen:
+                self.remove(mal_id)
+                changes['removed'] += 1
+        log.debug(f'Refreshed {self}: {dict(changes)}')
+        return changes
+
+    def _apply(self, data):
+        """ Apply a raw entry from Jikan, returning 'added', 'changed', or None if it's the same as ours. """
+        entry = AnimeListEntry(data)
+        existing = self.entries.get(entry.id)
+        if existing is not None and existing.state == entry.state:
+            return None
+        self.add(entry)
+        return 'changed' if existing is not None else 'added'
+
+    def add(self, entry):
+        """ Add an entry, replacing any existing entry for the same series. """
+        self.remove(entry.id)
+        self.entries[entry.id] = entry
+        self._by_status[entry.status.watching][entry.id] = entry
+
+    def remove(self, mal_id):
+        entry = self.entries.pop(mal_id, None)
+        if entry is not None:
+            del self._by_status[entry.status.watching][mal_id]
+        return entry
+
+    def set_status(self, mal_id, status=None, *, score=None, watched_episodes=None):
+        """ Change an entry's status, score or watched episodes, moving it to the right partition. """
+        entry = self.entries[mal_id]
+        if status is not None and status is not entry.status.watching:
+            del self._by_status[entry.status.watching][mal_id]
+            entry.status.watching = status
+            self._by_status[status][mal_id] = entry
+        if score is not None:
+            entry.status.score = score
+        if watched_episodes is not None:
+            entry.status.watched_episodes = watched_episodes
+        return entry
+
+    def get(self, mal_id, default=None):
+        return self.entries.get(mal_id, default)
+
+    def with_status(self, status):
+        """ Live view of the entries with the given WatchStatus. """
+        return self._by_status[status].values()
 
     def __len__(self):
-        return len(self._list)
+        return len(self.entries)
 
     def __iter__(self):
-        self._iter = 0
-        return self
-
-    def __next__(self):
-        if self._iter < len(self._list):
-            self._iter += 1
-            return self._list[self._iter - 1]
-        else:
-            raise StopIteration
+        return iter(self.entries.values())
 
     def __repr__(self):
         return f'<AnimeList: {self.user} [{len(self)}]>'
 
     def __contains__(self, obj):
-        return obj in self._list
+        """ Works with either a MAL ID or an AnimeListEntry. """
+        return getattr(obj, 'id', obj) in self.entries
 
-    def __getitem__(self, index):
-        return self._list[index]
+    def __getitem__(self, mal_id):
+        return self.entries[mal_id]
 
     @property
     def PTW(self):
-        return [i for i in self._list if i.status.watching is WatchStatus.PlanToWatch]
+        return self.with_status(WatchStatus.PlanToWatch)
 
     @property
     def Watching(self):
-        return [i for i in self._list if i.status.watching is WatchStatus.Watching]
+        return self.with_status(WatchStatus.Watching)
 
     @property
     def Completed(self):
-        return [i for i in self._list if i.status.watching is WatchStatus.Completed]
+        return self.with_status(WatchStatus.Completed)
 
 
 class AnimeListEntry(object):
-    def __init__(self, data):
+    __slots__ = ('id', 'title', 'type', 'airing', 'total_episodes', '_series', 'status')
+
+    def __init__(self, data, *, series=None):
         self.id = data['mal_id']
         self.title = data['title']
         self.type = AnimeType(data['type'])
         self.airing = AiringStatus(data['airing_status'])
         self.total_episodes = data['total_episodes']
-        self._series = None
+        self._series = series
 
         # user specific
         kwargs = {
@@ -78,6 +170,32 @@ class AnimeListEntry(object):
         }
         self.status = AnimeStatus(**kwargs)
 
+    @classmethod
+    def from_series(cls, series, status, score=0, watched_episodes=0):
+        """ Build an entry for a series that was just added to the list, without fetching the list. """
+        return cls({
+            'mal_id': series.id,
+            'title': series.title,
+            'type': series.type.value,
+            'airing_status': series.status.value,
+            'total_episodes': series.episode_count or 0,
+            'watching_status': status.value,
+            'score': score,
+            'watched_episodes': watched_episodes,
+        }, series=series)
+
+    def copy(self):
+        """ A copy whose status can be changed without touching this entry. """
+        entry = copy.copy(self)
+        entry.status = copy.copy(self.status)
+        return entry
+
+    @property
+    def state(self):
+        """ Everything about the entry that can change, for spotting changes on refresh. """
+        return (self.title, self.airing, self.total_episodes,
+                self.status.watching, self.status.score, self.status.watched_episodes)
+
     @property
     def series(self):
         if not self._series:
@@ -88,10 +206,18 @@ class AnimeListEntry(object):
         return f"<AnimeListEntry: {self.title} [{self.id}]>"
 
     def __eq__(self, other):
-        return self.series is other.series
+        # compare by ID, since going through .series would fetch the series
+        if not isinstance(other, AnimeListEntry):
+            return NotImplemented
+        return self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
 
 
 class AnimeStatus(object):
+    __slots__ = ('watching', 'score', 'watched_episodes')
+
     def __init__(self, *, status, score, watched_episodes):
         self.watching = WatchStatus(status)
         self.score = score
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# builtins
+import logging
+import threading
+
+# 3rd party
+import requests
+from jikanpy import Jikan
+from requests.adapters import HTTPAdapter
+
+# my modules
+from mal_automaton import config
+from mal_automaton.cache import get_cache, cache_key
+from mal_automaton.ratelimit import get_upstream
+
+
+log = logging.getLogger(__name__)
+
+_cache_config = config.get('cache') or {}
+_jikan_config = config.get('jikan') or {}
+# number of keep-alive connections kept open to each upstream host
+CONNECTIONS = _jikan_config.get('connections', 4)
+# all TTLs are in seconds
+TTL = {
+    'airing': 6 * 60 * 60,
+    'finished': 30 * 24 * 60 * 60,
+    'search': 7 * 24 * 60 * 60,
+    'user': 5 * 60,
+}
+TTL.update(_cache_config.get('ttl') or {})
+
+
+_adapter = None
+_adapter_lock = threading.Lock()
+
+
+def shared_adapter():
+    """ The HTTPAdapter (and so the connection pool) shared by every pooled session in the process. """
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            _adapter = HTTPAdapter(pool_maxsize=CONNECTIONS)
+    return _adapter
+
+
+def pooled_session():
+    """
+    A requests Session that reuses connections from the shared pool, which
+    keeps up to CONNECTIONS connections per host alive between requests.
+    Cookies are still kept per session.
+    """
+    session = requests.Session()
+    session.mount('https://', shared_adapter())
+    session.mount('http://', shared_adapter())
+    return session
+
+
+def anime_ttl(cache, id, resp):
+    """ Pick a TTL for an anime response based on whether the series is still airing. """
+    if 'airing' in resp:
+        airing = resp['airing']
+    else:
+        # episode pages don't carry the airing status, so use the details
+        details = cache.get(cache_key('anime', id))
+        airing = details['airing'] if details else True
+    return TTL['airing'] if airing else TTL['finished']
+
+
+class CachedJikan(object):
+    """
+    Drop-in wrapper around the parts of Jikan() that we use, which answers from
+    a persistent response cache before going out to the API. Responses served
+    from the local cache have their 'request_cached' flag set to True.
+
+    Series details and episode pages are kept for a short time while the series
+    is still airing, and for much longer once it has finished. User lists can
+    be fetched `fresh`, skipping the cache (but still refreshing it).
+    """
+    def __init__(self, cache=None, jikan=None):
+        self.cache = cache
+        self.jikan = jikan or Jikan(session=pooled_session())
+
+    def anime(self, id, extension=None, page=None):
+        key = cache_key('anime', id, extension, page)
+        return self._cached(key, lambda resp: self._anime_ttl(id, resp),
+                            self.jikan.anime, id, extension=extension, page=page)
+
+    def search(self, search_type, query, page=None, parameters=None):
+        key = cache_key('search', search_type, query.casefold(), page, parameters and sorted(parameters.items()))
+        return self._cached(key, lambda resp: TTL['search'],
+                            self.jikan.search, search_type, query, page=page, parameters=parameters)
+
+    def user(self, username, request=None, argument=None, page=None, parameters=None, fresh=False):
+        key = cache_key('user', username.casefold(), request, argument, page, parameters and sorted(parameters.items()))
+        return self._cached(key, lambda resp: TTL['user'],
+                            self.jikan.user, username=username, request=request, argument=argument,
+                            page=page, parameters=parameters, fresh=fresh)
+
+    def _anime_ttl(self, id, resp):
+        return anime_ttl(self.cache, id, resp)
+
+    def _cached(self, key, ttl, func, *args, fresh=False, **kwargs):
+        jikan = get_upstream('jikan')
+        if self.cache is None:
+            return jikan.call(func, *args, **kwargs)
+
+        resp = None if fresh else self.cache.get(key)
+        if resp is not None:
+            log.debug(f'Response cache hit for {key}')
+            resp['request_cached'] = True
+            return resp
+
+        log.debug(f'Response cache miss for {key}')
+        resp = jikan.call(func, *args, **kwargs)
+        self.cache.set(key, resp, ttl=ttl(resp))
+        return resp
+
+
+_jikan = None
+_jikan_lock = threading.Lock()
+
+
+def get_jikan():
+    """ Return the process-wide CachedJikan instance, creating it on first use. """
+    global _jikan
+    with _jikan_lock:
+        if _jikan is None:
+            if _cache_config.get('enabled', True):
+                _jikan = CachedJikan(get_cache('responses'))
+            else:
+                _jikan = CachedJikan()
+    return _jikan
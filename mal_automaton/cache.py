@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# builtins
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+# my modules
+from mal_automaton import config
+from mal_automaton.index import normalize_title
+
+
+log = logging.getLogger(__name__)
+
+_cache_config = config.get('cache') or {}
+DEFAULT_PATH = _cache_config.get('path', '~/.mal_automaton.cache')
+DEFAULT_MAX_ENTRIES = _cache_config.get('max_entries', 20000)
+
+
+class Cache(object):
+    """
+    A small persistent key/value store backed by a single SQLite table. Values
+    are stored as JSON, and every entry can have its own TTL. When the table
+    grows past `max_entries`, the least recently accessed entries are evicted.
+
+    Several caches can share the same file by using different table names.
+    A `private` cache's file is only readable by the current user (SQLite
+    gives its WAL files the same permissions).
+    """
+    def __init__(self, path=DEFAULT_PATH, table='responses', *, max_entries=DEFAULT_MAX_ENTRIES, private=False):
+        self.path = path if path == ':memory:' else str(Path(path).expanduser())
+        self.table = table
+        self.max_entries = max_entries
+        if private and self.path != ':memory:':
+            Path(self.path).touch(mode=0o600)
+            Path(self.path).chmod(0o600)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        if self.path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                         'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, accessed REAL NOT NULL)')
+
+    def get(self, key, default=None):
+        """ Return the value stored under `key`, or `default` if missing or expired. """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(f'SELECT value, expires FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return default
+            value, expires = row
+            if expires is not None and expires <= now:
+                self._db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                return default
+            self._db.execute(f'UPDATE {self.table} SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        """ Store `value` under `key`. A `ttl` of None means it never expires. """
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            self._db.execute(f'INSERT OR REPLACE INTO {self.table} (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                             (key, json.dumps(value), expires, now))
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute(f'DELETE FROM {self.table}')
+
+    def items(self, prefix=''):
+        """ Every unexpired (key, value) pair whose key starts with `prefix`. """
+        with self._lock:
+            rows = self._db.execute(f'SELECT key, value FROM {self.table} WHERE substr(key, 1, ?) = ? '
+                                    'AND (expires IS NULL OR expires > ?)', (len(prefix), prefix, time.time())).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def _evict(self):
+        """ Drop expired entries, then the least recently used ones over the cap. """
+        self._db.execute(f'DELETE FROM {self.table} WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+        if self.max_entries is None:
+            return
+        overflow = len(self) - self.max_entries
+        if overflow > 0:
+            log.debug(f'Evicting {overflow} entries from the {self.table} cache.')
+            self._db.execute(f'DELETE FROM {self.table} WHERE key IN '
+                             f'(SELECT key FROM {self.table} ORDER BY accessed LIMIT ?)', (overflow,))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def __repr__(self):
+        return f'<Cache: {self.path} [{self.table}]>'
+
+
+class NameCache(object):
+    """
+    Persistent lookup of series names to IDs, so that a name only ever has to
+    go through a search endpoint once. Names are normalized (casefolded and
+    stripped of punctuation) before use. Besides the names that were actually
+    searched for, it learns the alternate titles of every series we fetch.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.stats = Counter(hits=0, misses=0)
+
+    def get(self, name):
+        id = self.cache.get(normalize_title(name))
+        self.stats['hits' if id is not None else 'misses'] += 1
+        return id
+
+    def set(self, name, id):
+        self.cache.set(normalize_title(name), id)
+
+    def learn(self, id, *names):
+        """ Remember alternate names for `id`, without overriding anything already known. """
+        for name in names:
+            if name and normalize_title(name) and self.cache.get(normalize_title(name)) is None:
+                self.set(name, id)
+
+    @property
+    def hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.0
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+_name_caches = {}
+
+
+def get_cache(table, **kwargs):
+    """
+    Return the process-wide Cache for `table`, creating it on first use. If
+    caching is disabled in the config, the cache only lives in memory.
+    """
+    with _caches_lock:
+        if table not in _caches:
+            path = DEFAULT_PATH if _cache_config.get('enabled', True) else ':memory:'
+            _caches[table] = Cache(path, table, **kwargs)
+        return _caches[table]
+
+
+def get_name_cache(kind):
+    """ Return the process-wide NameCache for a kind of ID (e.g. 'mal' or 'tvdb'). """
+    cache = get_cache(f'{kind}_names')
+    with _caches_lock:
+        if kind not in _name_caches:
+            _name_caches[kind] = NameCache(cache)
+        return _name_caches[kind]
+
+
+def cache_key(*parts):
+    """ Build a cache key like 'anime/16498/episodes/2', skipping empty parts. """
+    return '/'.join(str(part) for part in parts if part is not None)
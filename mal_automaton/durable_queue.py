@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# builtins
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# my modules
+from mal_automaton.utils import loads
+
+
+log = logging.getLogger(__name__)
+
+
+class DurableQueue(object):
+    """
+    A FIFO queue of JSON payloads persisted to a SQLite table (in WAL mode),
+    so that nothing is lost if the process dies. Items are claimed with get(),
+    and stay in the table until they're marked done(). Failed items are
+    retried with a growing delay, up to `max_attempts` times. Anything still
+    claimed when the process stopped is put back in line by recover().
+    """
+    PENDING = 'pending'
+    WORKING = 'working'
+    FAILED = 'failed'
+
+    def __init__(self, path, table='webhooks', *, max_depth=1000, max_attempts=5, retry_delay=30):
+        self.path = path if path == ':memory:' else str(Path(path).expanduser())
+        self.table = table
+        self.max_depth = max_depth
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._lock = threading.Condition(threading.RLock())
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        if self.path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, state TEXT NOT NULL, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, not_before REAL NOT NULL, received REAL NOT NULL)')
+
+    def put(self, payload):
+        """ Append a payload, raising queue.Full if the queue is at its maximum depth. """
+        now = time.time()
+        with self._lock:
+            if self.max_depth is not None and self.depth >= self.max_depth:
+                raise queue.Full
+            cursor = self._db.execute(f'INSERT INTO {self.table} (payload, state, not_before, received) '
+                                      'VALUES (?, ?, ?, ?)', (json.dumps(payload), self.PENDING, now, now))
+            self._lock.notify()
+            return cursor.lastrowid
+
+    def get(self, timeout=None):
+        """
+        Claim the oldest pending payload that's due, waiting up to `timeout`
+        seconds for one. Returns an (id, payload) tuple, or None on timeout.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            while True:
+                item = self._claim()
+                if item is not None:
+                    return item
+                remaining = deadline - time.monotonic() if deadline is not None else 1
+                if remaining <= 0:
+                    return None
+                # poll at least every second, so delayed retries get picked up
+                self._lock.wait(min(remaining, 1))
+
+    def _claim(self):
+        row = self._db.execute(f'SELECT id, payload FROM {self.table} WHERE state = ? AND not_before <= ? '
+                               'ORDER BY id LIMIT 1', (self.PENDING, time.time())).fetchone()
+        if row is None:
+            return None
+        self._db.execute(f'UPDATE {self.table} SET state = ? WHERE id = ?', (self.WORKING, row[0]))
+        return row[0], loads(row[1])
+
+    def done(self, id):
+        with self._lock:
+            self._db.execute(f'DELETE FROM {self.table} WHERE id = ?', (id,))
+
+    def fail(self, id, *, permanent=False):
+        """
+        Put a payload back in line for a later retry, or give up on it after
+        too many attempts (or straight away, if the failure is `permanent`).
+        """
+        with self._lock:
+            attempts = self._db.execute(f'SELECT attempts FROM {self.table} WHERE id = ?', (id,)).fetchone()[0] + 1
+            if permanent or attempts >= self.max_attempts:
+                log.warning(f'Giving up on queued item {id} after {attempts} attempts.')
+                state, not_before = self.FAILED, time.time()
+            else:
+                state, not_before = self.PENDING, time.time() + self.retry_delay * 2 ** (attempts - 1)
+            self._db.execute(f'UPDATE {self.table} SET state = ?, attempts = ?, not_before = ? WHERE id = ?',
+                             (state, attempts, not_before, id))
+
+    def recover(self):
+        """ Requeue anything that was claimed but never finished (e.g. because of a crash). """
+        with self._lock:
+            cursor = self._db.execute(f'UPDATE {self.table} SET state = ? WHERE state = ?', (self.PENDING, self.WORKING))
+            if cursor.rowcount:
+                log.info(f'Recovered {cursor.rowcount} unfinished items from the queue.')
+                self._lock.notify_all()
+            return cursor.rowcount
+
+    def wake(self):
+        """ Wake up everything waiting in get(). """
+        with self._lock:
+            self._lock.notify_all()
+
+    def count(self, state):
+        with self._lock:
+            return self._db.execute(f'SELECT COUNT(*) FROM {self.table} WHERE state = ?', (state,)).fetchone()[0]
+
+    @property
+    def depth(self):
+        """ Number of payloads that haven't been processed (or given up on) yet. """
+        with self._lock:
+            return self._db.execute(f'SELECT COUNT(*) FROM {self.table} WHERE state != ?', (self.FAILED,)).fetchone()[0]
+
+    def __len__(self):
+        return self.depth
+
+    def __repr__(self):
+        return f'<DurableQueue: {self.path} [{self.table}]>'
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# builtins
+import threading
+import unicodedata
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+
+ONE_DAY = timedelta(days=1, seconds=1)
+
+
+class AirdateIndex(object):
+    """
+    Sorted index of episode airdates (as POSIX timestamps) across several
+    series, so that finding every episode that aired around a given date is a
+    binary search instead of a scan. Series are added to the index one at a
+    time, so only the series that actually need checking have to be loaded.
+    """
+    def __init__(self):
+        self._timestamps = []
+        self._episodes = []
+        self._indexed = set()
+        self._lock = threading.Lock()
+
+    def add(self, series):
+        """ Add every episode of `series` with a known airdate to the index. """
+        if series.id in self._indexed:
+            return
+        # loading the episodes can go out to the network, so lookups aren't held up while it does
+        dated = [(ep.airdate.timestamp(), ep) for ep in series.episodes if ep.airdate]
+        with self._lock:
+            # another thread may have added it in the meantime
+            if series.id in self._indexed:
+                return
+            merged = sorted(list(zip(self._timestamps, self._episodes)) + dated, key=lambda pair: pair[0])
+            self._timestamps = [ts for ts, _ in merged]
+            self._episodes = [ep for _, ep in merged]
+            self._indexed.add(series.id)
+
+    def near(self, airdate, window=ONE_DAY):
+        """
+        Return all indexed episodes that aired less than `window` away from
+        `airdate`, closest first.
+        """
+        target = airdate.timestamp()
+        span = window.total_seconds()
+        with self._lock:
+            lo = bisect_right(self._timestamps, target - span)
+            hi = bisect_left(self._timestamps, target + span)
+            found = list(zip(self._timestamps[lo:hi], self._episodes[lo:hi]))
+        return [ep for _, ep in sorted(found, key=lambda pair: abs(pair[0] - target))]
+
+    def __contains__(self, series):
+        return series.id in self._indexed
+
+    def __len__(self):
+        return len(self._timestamps)
+
+
+def normalize_title(title):
+    """ Casefold a title and replace punctuation with spaces, so trivial differences don't matter. """
+    title = unicodedata.normalize('NFKC', title).casefold()
+    title = ''.join(' ' if unicodedata.category(char)[0] in 'PS' else char for char in title)
+    return ' '.join(title.split())
+
+
+def trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TitleIndex(object):
+    """
+    Index of episode titles (both the English and romanized ones) across
+    several series. Exact matches are looked up by their normalized title, and
+    anything else falls back to a fuzzy search over a trigram inverted index,
+    scored with the Dice coefficient of the two titles' trigrams.
+    """
+    def __init__(self):
+        self._exact = defaultdict(list)   # normalized title -> [episode]
+        self._grams = defaultdict(set)    # trigram -> {entry number}
+        self._entries = []                # (episode, trigrams)
+        self._indexed = set()
+        self._lock = threading.Lock()
+
+    def add(self, series):
+        """ Add the titles of every episode of `series` to the index. """
+        if series.id in self._indexed:
+            return
+        # like AirdateIndex.add(), the episodes are loaded before taking the lock
+        titles = [(ep, normalize_title(title)) for ep in series.episodes
+                  for title in (ep.title, ep.title_romanji) if title]
+        with self._lock:
+            if series.id in self._indexed:
+                return
+            for ep, title in titles:
+                self._add_title(ep, title)
+            self._indexed.add(series.id)
+
+    def _add_title(self, episode, title):
+        self._exact[title].append(episode)
+        grams = trigrams(title)
+        number = len(self._entries)
+        self._entries.append((episode, grams))
+        for gram in grams:
+            self._grams[gram].add(number)
+
+    def match(self, title, threshold=0.0):
+        """
+        Return the best matching episode for `title` and its score (1.0 for
+        an exact match), or (None, 0.0) if nothing scores at least `threshold`.
+        """
+        key = normalize_title(title)
+        with self._lock:
+            if self._exact.get(key):
+                return self._exact[key][0], 1.0
+
+            query = trigrams(key)
+            shared = Counter(number for gram in query for number in self._grams.get(gram, ()))
+            best, best_score = None, 0.0
+            # entry order breaks ties, so earlier series win
+            for number in sorted(shared):
+                episode, grams = self._entries[number]
+                score = 2 * shared[number] / (len(query) + len(grams))
+                if score > best_score:
+                    best, best_score = episode, score
+
+        if best is None or best_score < threshold:
+            return None, 0.0
+        return best, best_score
+
+    def __contains__(self, series):
+        return series.id in self._indexed
@@ -1,20 +1,34 @@
 #!/usr/bin/env python3
 
 # builtins
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from difflib import SequenceMatcher
 from itertools import combinations
 from collections import Counter
 from textwrap import shorten
 
 # 3rd party
-from jikanpy import Jikan
 from dateutil.parser import isoparse
 
 # my modules
+from mal_automaton import config
+from mal_automaton.api import get_jikan
+from mal_automaton.cache import get_name_cache
+from mal_automaton.index import AirdateIndex, TitleIndex, ONE_DAY
 from mal_automaton.memoizer import memento_factory
 from mal_automaton.enums import AnimeType, AiringStatus, AnimeSource
 
 
+log = logging.getLogger(__name__)
+
+_jikan_config = config.get('jikan') or {}
+# Jikan only allows a couple of requests per second, so keep this small
+PAGE_WORKERS = _jikan_config.get('page_workers', 2)
+
+
 def SeriesIDFactory(cls, *args, **kwargs):
     """
     Function that returns a MAL ID from either a given name or ID. Used by the
@@ -23,11 +37,14 @@ def SeriesIDFactory(cls, *args, **kwargs):
     on init parameters (default mementos behavior)
     """
     def series_memo_identifier(id=None, *, name=None):
-        jikan = Jikan()
+        names = get_name_cache('mal')
         if id:
             mal_id = id
         elif name:
-            mal_id = jikan.search('anime', name)['results'][0]['mal_id']
+            mal_id = names.get(name)
+            if mal_id is None:
+                mal_id = get_jikan().search('anime', name)['results'][0]['mal_id']
+                names.set(name, mal_id)
         else:
             raise ValueError('You must specify an ID or name.')
         return mal_id
@@ -50,17 +67,19 @@ to use, and we use that as the key. Without including the class in the tuple,
 creating a series with the same ID as an already created Franchise will only
 return that franchise, and vice versa.
 """
-MAL_SeriesMemoizer = memento_factory('MAL_SeriesMemoizer', SeriesIDFactory, use_key=True)
-MAL_EpisodeMemoizer = memento_factory('MAL_EpisodeMemoizer', EpisodeIDFactory)
+MAL_SeriesMemoizer = memento_factory('MAL_SeriesMemoizer', SeriesIDFactory, use_key=True,
+                                     maxsize=256, ttl=24 * 60 * 60)
+MAL_EpisodeMemoizer = memento_factory('MAL_EpisodeMemoizer', EpisodeIDFactory, maxsize=10000)
 
 
 class MAL_Franchise(object, metaclass=MAL_SeriesMemoizer):
     def __init__(self, id=None, *, name=None):
-        self._jikan = Jikan()
         self.series = self._get_franchise_list(id)
         self.title = self._discern_title()
         self.release_run = (self.series[0].premiered, self.series[-1].ended)
-        self._absolute = [ep for series in self.series for ep in series.episodes]
+        self._absolute = None
+        self._airdates = AirdateIndex()
+        self._titles = TitleIndex()
 
     def _discern_title(self):
         substrings = Counter()
@@ -118,59 +137,133 @@ class MAL_Franchise(object, metaclass=MAL_SeriesMemoizer):
 
     def absolute_episode(self, index):
         # make one big (ordered) list of episodes, and get the correct index from that list
+        if self._absolute is None:
+            self._absolute = [ep for series in self.series for ep in series.episodes]
         return self._absolute[index - 1]
 
+    @property
+    def id(self):
+        """ The MAL ID of the first series in the franchise. """
+        return self.series[0].id
+
+    @property
+    def fingerprint(self):
+        """ Summary of the franchise's series, which changes when a series is added or changes status. """
+        return [[series.id, series.status.value] for series in self.series]
+
+    def episodes_aired_near(self, airdate, window=ONE_DAY):
+        """
+        Find every episode in the franchise that aired less than `window` away
+        from `airdate`, closest first. Only the series whose run could include
+        that date have their episodes loaded into the index.
+        """
+        for series in self.series:
+            if series not in self._airdates and series.might_have_aired(airdate):
+                self._airdates.add(series)
+        return self._airdates.near(airdate, window)
+
+    def episode_titled(self, title, threshold=0.0):
+        """
+        Find the episode in the franchise whose title best matches `title`.
+        Returns a tuple of (episode, score), where a score of 1.0 is an exact
+        match (ignoring case and punctuation).
+        """
+        for series in self.series:
+            if series not in self._titles:
+                self._titles.add(series)
+        return self._titles.match(title, threshold)
+
     def __repr__(self):
         return f"<MAL_Franchise: {self.title}>"
 
 
 class MAL_Series(object, metaclass=MAL_SeriesMemoizer):
+    _lazy_fields = ('synopsis', 'background')
+
     def __init__(self, id=None, *, name=None):
-        self._jikan = Jikan()
         self.id = id
-        self._raw = self._jikan.anime(self.id)
-        self._cached = self._raw['request_cached']
+        # the response itself isn't kept (see raw), and neither are the heavy fields, until they're asked for
+        raw = get_jikan().anime(self.id)
+        self._lazy = {}
+        self._cached = raw['request_cached']
         # MAL meta info
-        self.url = self._raw['url']
-        self.image_url = self._raw['image_url']
+        self.url = raw['url']
+        self.image_url = raw['image_url']
         # titles
-        self.title = self._raw['title']
-        self.title_en = self._raw['title_english']
-        self.title_jp = self._raw['title_japanese']
-        self.synonyms = self._raw['title_synonyms']
+        self.title = raw['title']
+        self.title_en = raw['title_english']
+        self.title_jp = raw['title_japanese']
+        self.synonyms = raw['title_synonyms']
+        get_name_cache('mal').learn(self.id, self.title, self.title_en, *(self.synonyms or []))
         # series meta info
-        self.type = AnimeType(self._raw['type'])
-        self.source = AnimeSource(self._raw['source'])
-        self.status = AiringStatus(self._raw['status'])
-        self.score = self._raw['score']
-        self.rank = self._raw['rank']
+        self.type = AnimeType(raw['type'])
+        self.source = AnimeSource(raw['source'])
+        self.status = AiringStatus(raw['status'])
+        self.score = raw['score']
+        self.rank = raw['rank']
         # release date info
-        self.airing = self._raw['airing']   # bool
-        if not self._raw['aired']['from']:
+        self.airing = raw['airing']   # bool
+        if not raw['aired']['from']:
             self.premiered = None
         else:
-            self.premiered = isoparse(self._raw['aired']['from'])
-        if not self._raw['aired']['to']:
+            self.premiered = isoparse(raw['aired']['from'])
+        if not raw['aired']['to']:
             self.ended = None
         else:
-            self.ended = isoparse(self._raw['aired']['to'])
-        self.release_run = self._raw['aired']['string']
-        self.release_season = self._raw['premiered']
+            self.ended = isoparse(raw['aired']['to'])
+        self.release_run = raw['aired']['string']
+        self.release_season = raw['premiered']
+        self.episode_count = raw['episodes']   # None while unknown
         # series info
-        self.synopsis = self._raw['synopsis']
-        self.background = self._raw['background']
-        self.studio = self._raw['studios']
-        self.rating = self._raw['rating']
-        self.episodes = self.fetch_episodes()
+        self.studio = raw['studios']
+        self.rating = raw['rating']
+        # episodes are only fetched once they're needed
+        self._episodes = None
+        self._episodes_lock = threading.Lock()
         try:
-            self._sequel_id = self._raw['related'].get('Sequel')[0]['mal_id']
+            self._sequel_id = raw['related'].get('Sequel')[0]['mal_id']
         except TypeError:
             self._sequel_id = None
         try:
-            self._prequel_id = self._raw['related'].get('Prequel')[0]['mal_id']
+            self._prequel_id = raw['related'].get('Prequel')[0]['mal_id']
         except TypeError:
             self._prequel_id = None
 
+    @property
+    def episodes(self):
+        with self._episodes_lock:
+            if self._episodes is None:
+                self._episodes = self.fetch_episodes()
+        return self._episodes
+
+    @property
+    def synopsis(self):
+        return self._load_lazy('synopsis')
+
+    @property
+    def background(self):
+        return self._load_lazy('background')
+
+    def _load_lazy(self, field):
+        """ Fetch a heavy field that was dropped from the response (usually served from the local cache). """
+        if field not in self._lazy:
+            resp = self.raw
+            self._lazy.update({key: resp[key] for key in self._lazy_fields})
+        return self._lazy[field]
+
+    @property
+    def raw(self):
+        """ The full Jikan response for the series. It isn't kept around, so it's fetched again (usually from the cache). """
+        return get_jikan().anime(self.id)
+
+    def might_have_aired(self, date, margin=timedelta(days=7)):
+        """ Whether an episode of this series could have aired on `date`, going by its release run. """
+        if self.premiered and date < self.premiered - margin:
+            return False
+        if self.ended and date > self.ended + margin:
+            return False
+        return True
+
     @property
     def sequel(self):
         return MAL_Series(self._sequel_id) if self._sequel_id else None
@@ -184,20 +277,30 @@ class MAL_Series(object, metaclass=MAL_SeriesMemoizer):
         Fetch all episodes of a series (automatically de-paginates, so we
         *actually* get them all, not just the first page)
         """
-        resp = self._jikan.anime(self.id, extension='episodes')
+        resp = get_jikan().anime(self.id, extension='episodes')
         episodes = resp['episodes']
         last_page = resp['episodes_last_page']
         if last_page > 1:
-            for i in range(2, last_page + 1):
-                episodes += self._jikan.anime(self.id, extension='episodes', page=i)['episodes']
+            # fetch the rest of the pages concurrently; map() keeps them in order
+            with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+                for page in pool.map(self._fetch_episode_page, range(2, last_page + 1)):
+                    episodes += page
         # return as episode object
         return [MAL_Episode(self, ep) for ep in episodes]
 
+    def _fetch_episode_page(self, page):
+        # rate limiting and retries are handled by the Jikan wrapper
+        return get_jikan().anime(self.id, extension='episodes', page=page)['episodes']
+
     def __repr__(self):
         return f"<MAL_Series: {self.title} [{self.id}]>"
 
 
 class MAL_Episode(object, metaclass=MAL_EpisodeMemoizer):
+    # there can be tens of thousands of these cached, so no __dict__ (the memoizer needs the weakref slot)
+    __slots__ = ('series', 'id', 'title', 'title_romanji', 'airdate', 'is_filler', 'is_recap', 'video_url',
+                 '__weakref__')
+
     def __init__(self, series, data):
         self.series = series
         self.id = data['episode_id']
@@ -5,33 +5,223 @@ This code is a tweaked version of the 'mementos' package by Jonathan Eunice,
 found here: https://bitbucket.org/jeunice/mementos/src/default/
 """
 
+# builtins
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+
+# my modules
+from mal_automaton import config
+
+
+# maps each memoized class to its MementoCache
 _memento_cache = {}
+_memento_cache_lock = threading.Lock()
+_memo_config = config.get('memo') or {}
+
+
+class MementoCache(object):
+    """
+    Bounded memo cache for a single class. Up to `maxsize` instances are kept
+    alive in LRU order, and each one is dropped `ttl` seconds after it was
+    built. Instances pushed out by the size limit are only held weakly, so
+    anything still referenced elsewhere keeps being returned for its key.
+
+    The cache is thread-safe, and get_or_build() makes sure only one thread
+    ever builds the instance for a given key at a time.
+    """
+    def __init__(self, maxsize=None, ttl=None, stats=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = stats if stats is not None else Counter()
+        self.lock = threading.RLock()
+        self._entries = OrderedDict()   # key -> (instance, expires)
+        self._evicted = weakref.WeakValueDictionary()
+        self._evicted_expires = {}
+        self._in_flight = {}   # key -> _Flight
+
+    def get_or_build(self, key, build):
+        """
+        Return the instance for `key`, calling `build()` to create it if needed.
+        Concurrent callers asking for a key that is already being built wait
+        for that build and get the same instance. If the build fails, every
+        waiter gets the exception, and nothing is cached.
+        """
+        with self.lock:
+            try:
+                return self.get(key)
+            except KeyError:
+                pass
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            instance = build()
+        except BaseException as e:
+            flight.error = e
+            raise
+        else:
+            with self.lock:
+                self.set(key, instance)
+            flight.instance = instance
+            return instance
+        finally:
+            with self.lock:
+                del self._in_flight[key]
+            flight.done.set()
+
+    def get(self, key):
+        """ Return the cached instance for `key`, raising KeyError if there isn't one. """
+        now = time.monotonic()
+        try:
+            instance, expires = self._entries[key]
+        except KeyError:
+            instance = self._evicted.get(key)
+            expires = self._evicted_expires.get(key)
+            if instance is None:
+                self.stats['misses'] += 1
+                raise
+            # still alive somewhere, so bring it back into the LRU
+            self._forget(key)
+            self._entries[key] = (instance, expires)
+
+        if expires is not None and expires <= now:
+            self._forget(key)
+            self.stats['expirations'] += 1
+            self.stats['misses'] += 1
+            raise KeyError(key)
+
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return instance
+
+    def set(self, key, instance):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._forget(key)
+        self._entries[key] = (instance, expires)
+        self._evict()
+
+    def invalidate(self, key=None):
+        """ Forget the instance for `key`, or every instance if no key is given. """
+        if key is None:
+            self._entries.clear()
+            self._evicted = weakref.WeakValueDictionary()
+            self._evicted_expires.clear()
+        else:
+            self._forget(key)
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+        self._evicted.pop(key, None)
+        self._evicted_expires.pop(key, None)
 
+    def _evict(self):
+        if self.maxsize is None:
+            return
+        while len(self._entries) > self.maxsize:
+            key, (instance, expires) = self._entries.popitem(last=False)
+            try:
+                self._evicted[key] = instance
+                self._evicted_expires[key] = expires
+            except TypeError:
+                # doesn't support weak references, so just drop it
+                pass
+            self.stats['evictions'] += 1
 
-def memento_factory(name, func, *, use_key=False):
+        # drop the expiry times of weakly held instances that have since died
+        if len(self._evicted_expires) > 2 * len(self._evicted) + 64:
+            self._evicted_expires = {k: v for k, v in self._evicted_expires.items() if k in self._evicted}
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._evicted
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Flight(object):
+    """ An instance that is currently being built by some thread. """
+    def __init__(self):
+        self.owner = threading.get_ident()
+        self.done = threading.Event()
+        self.instance = None
+        self.error = None
+
+    def wait(self):
+        if self.owner == threading.get_ident():
+            raise RuntimeError('Recursive construction of a memoized object.')
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.instance
+
+
+def _cache_for(cls):
+    """ Get (or create) the MementoCache for a memoized class. """
+    with _memento_cache_lock:
+        try:
+            return _memento_cache[cls]
+        except KeyError:
+            metaclass = type(cls)
+            settings = _memo_config.get(cls.__name__) or {}
+            cache = MementoCache(maxsize=settings.get('maxsize', metaclass.maxsize),
+                                 ttl=settings.get('ttl', metaclass.ttl),
+                                 stats=metaclass.stats)
+            _memento_cache[cls] = cache
+            return cache
+
+
+def memento_factory(name, func, *, use_key=False, maxsize=None, ttl=None):
     """
     Return a memoizing metaclass with the given name and key function.
     That makes this a parametrized meta-metaclass, which is probably
     the most meta thing you've ever seen. If it isn't, both congratulations
     and sympathies are in order!
+
+    `maxsize` and `ttl` bound the memo cache of every class using the
+    metaclass, and can be overridden per class name in the 'memo' section of
+    the config. Hit/miss/eviction counts are kept in the metaclass's `stats`.
     """
     def call(cls, *args, **kwargs):
         identifier = func(cls, *args, **kwargs)
-        key = (cls, identifier)
-        try:
-            return _memento_cache[key]
-        except KeyError:
+
+        def build():
             if use_key:
-                instance = type.__call__(cls, identifier)
-            else:
-                instance = type.__call__(cls, *args, **kwargs)
-            _memento_cache[key] = instance
-            return instance
+                return type.__call__(cls, identifier)
+            return type.__call__(cls, *args, **kwargs)
 
-    mc = type(name, (type,), {'__call__': call})
+        return _cache_for(cls).get_or_build(identifier, build)
+
+    def invalidate(cls, identifier=None):
+        """ Forget a memoized instance of this class (or all of them). """
+        cache = _cache_for(cls)
+        with cache.lock:
+            cache.invalidate(identifier)
+
+    namespace = {
+        '__call__': call,
+        'invalidate': invalidate,
+        'maxsize': maxsize,
+        'ttl': ttl,
+        'stats': Counter(hits=0, misses=0, evictions=0, expirations=0),
+    }
+    mc = type(name, (type,), namespace)
     return mc
 
 
+def invalidate_all():
+    """ Empty the memo cache of every memoized class. """
+    for cache in list(_memento_cache.values()):
+        with cache.lock:
+            cache.invalidate()
+
+
 """
 The key differences between this memento_factory() and the one from the
 "mementos" package are:
@@ -39,5 +229,7 @@ The key differences between this memento_factory() and the one from the
     instead of needing to be including explicitly.
     * You can choose whether to initialize the object with just the memo cache
     key, or with all the arguments the class was originally called with.
+    * Each class gets its own bounded cache, with LRU and TTL eviction.
+    * Construction is thread-safe, and concurrent calls for the same key only
+    build the object once.
 """
-
@@ -1,19 +1,78 @@
 #!/usr/bin/env python3
 
 # builtins
+from collections import Counter, OrderedDict
 from enum import Enum
 import re
+import threading
+import time
 
 # my modules
-from mal_automaton.utils import AttrDict
+from mal_automaton import config
+from mal_automaton.utils import AttrView
 from mal_automaton.enums import PlexEvent
 from mal_automaton.tvdb import TVDB_Series
 
 
+_plex_config = config.get('plex') or {}
+# only scrobbles actually change anything on MAL
+PROCESSED_EVENTS = _plex_config.get('events') or [PlexEvent.scrobble.value]
+# repeats of the same event for the same user and item are dropped within this many seconds
+COALESCE_WINDOW = _plex_config.get('coalesce_window', 10 * 60)
+
+
+class WebhookFilter(object):
+    """
+    Cheap checks run on the raw webhook payload before it's parsed or
+    resolved: webhooks for events we don't act on are ignored, and repeats of
+    the same event for the same user and item within `window` seconds are
+    coalesced into the first one.
+    """
+    def __init__(self, events=PROCESSED_EVENTS, window=COALESCE_WINDOW):
+        self.events = set(events)
+        self.window = window
+        self.stats = Counter(ignored=0, coalesced=0)
+        self._seen = OrderedDict()   # key -> time it was last let through
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(payload):
+        metadata = payload.get('Metadata') or {}
+        item = metadata.get('guid') or metadata.get('ratingKey')
+        return ((payload.get('Account') or {}).get('id'), item, payload.get('event'))
+
+    def __call__(self, payload):
+        """ Whether this payload should go on to be processed. """
+        if payload.get('event') not in self.events:
+            self._count('ignored')
+            return False
+
+        key = self.key(payload)
+        now = time.monotonic()
+        with self._lock:
+            # forget anything that has fallen out of the window
+            while self._seen and next(iter(self._seen.values())) <= now - self.window:
+                self._seen.popitem(last=False)
+            if key in self._seen:
+                self.stats['coalesced'] += 1
+                return False
+            self._seen[key] = now
+        return True
+
+    def forget(self, payload):
+        """ Let the next repeat of this payload through, e.g. because it couldn't be queued after all. """
+        with self._lock:
+            self._seen.pop(self.key(payload), None)
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+
 class PlexWebhook(object):
     def __init__(self, webhook):
-        # convert to AttrDict for easier use here
-        webhook = AttrDict(webhook)
+        # only the parts we read get wrapped, the payload itself isn't copied
+        webhook = AttrView(webhook)
 
         self.is_server_hook = webhook.owner
         self.is_user_hook = webhook.user
@@ -59,6 +118,9 @@ class MediaObject(object):
         self.library_type = self.LibrarySectionType(metadata.librarySectionType)
         self.library_title = metadata.librarySectionTitle
         self.media_type = self.MediaType(metadata.type)
+        self.tvdb_id = None
+        # TVDB info is only fetched when it's first needed
+        self._tvdb = None
 
         if self.media_type is self.MediaType.Episode:
             self.title = metadata.title
@@ -69,9 +131,15 @@ class MediaObject(object):
             # get tvdb_id
             regex = r'com\.plexapp\.agents\.thetvdb:\/\/(\d+)[\?\/]'
             match = re.search(regex, metadata.grandparentGuid)
-            _tvdb_id = int(match.group(1)) if match else None
+            self.tvdb_id = int(match.group(1)) if match else None
+
+    @property
+    def tvdb(self):
+        if self._tvdb is None and self.tvdb_id is not None:
+            self._tvdb = TVDB_Series(self.tvdb_id).episode(self.season, self.episode)
+        return self._tvdb
 
-            _series = TVDB_Series(_tvdb_id) if _tvdb_id is not None else None
-            self.tvdb = _series.seasons[self.season].episodes[self.episode]
-            self.airdate = self.tvdb.airdate
+    @property
+    def airdate(self):
+        return self.tvdb.airdate if self.tvdb else None
 
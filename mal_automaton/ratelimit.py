@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Process-wide rate limiting and retries for every upstream we talk to. Each
+upstream (Jikan, TheTVDB and myanimelist.net itself) gets one Upstream,
+shared by every thread and event loop in the process, so the configured
+rate holds no matter how many webhooks are being resolved at once.
+"""
+
+# builtins
+import asyncio
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# 3rd party
+import requests
+from jikanpy.exceptions import APIException
+try:
+    from aiohttp import ClientConnectionError
+except ImportError:
+    # only used by the async layer
+    ClientConnectionError = requests.ConnectionError
+
+# my modules
+from mal_automaton import config
+
+
+log = logging.getLogger(__name__)
+
+_limits_config = config.get('rate_limits') or {}
+# Jikan allows 2 requests/second and 30/minute, the others aren't documented
+DEFAULT_LIMITS = {
+    'jikan': {'rate': 0.5, 'burst': 2},
+    'tvdb': {'rate': 5, 'burst': 10},
+    'mal': {'rate': 1, 'burst': 2},
+}
+# responses that are worth trying again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per second on average, and bursts of up to `burst`
+    requests at once. Callers take a token before every request, and wait
+    (outside the lock) until it's theirs. pause() stops handing out tokens for
+    a while, e.g. when the upstream sends a Retry-After.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """ Take a token, returning how many seconds to wait before using it. """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # tokens can go negative, which queues callers up behind each other
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            return max(wait, self._paused_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RetryBudget(object):
+    """
+    Caps retries to a fraction of the requests being made, so that an
+    upstream that's down doesn't get hammered with retries on top of the
+    usual traffic. Every request deposits `ratio` of a retry (up to
+    `reserve`), and every retry spends a whole one.
+    """
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = reserve
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.reserve, self._balance + self.ratio)
+
+    def withdraw(self):
+        """ Spend a retry, returning False if there are none left. """
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+def status_of(error):
+    """ The HTTP status behind an exception (or response), if there is one. """
+    if isinstance(error, APIException):
+        return error.status_code
+    response = getattr(error, 'response', error)
+    return getattr(response, 'status_code', None) or getattr(response, 'status', None)
+
+
+def retry_after(error):
+    """
+    Seconds the upstream asked us to wait for, going by the Retry-After
+    header. Jikan's errors come as an APIException without the response, so
+    there's never one for Jikan, and its 429s are just backed off from.
+    """
+    response = getattr(error, 'response', error)
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def is_retryable(error):
+    """ Whether a failed request might work if it's tried again. """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, ClientConnectionError, asyncio.TimeoutError)):
+        return True
+    return status_of(error) in RETRY_STATUSES
+
+
+class Upstream(object):
+    """
+    Everything that goes to one upstream API goes through call(): it waits
+    for the rate limiter, and retries failures that are worth retrying with
+    exponential backoff and full jitter, while the retry budget allows it.
+    Requests functions that return a response instead of raising are retried
+    on the same statuses. A Retry-After from the upstream pauses every caller
+    (except for Jikan, whose errors don't carry their headers).
+
+    Requests that aren't safe to repeat (e.g. adding to a list) should pass
+    `idempotent=False`: they're only retried on a 429, where the upstream has
+    turned them down without doing anything.
+    """
+    def __init__(self, name, *, rate=1, burst=1, tries=4, backoff=1, max_backoff=60, budget=0.2):
+        self.name = name
+        self.tries = tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = TokenBucket(rate, burst)
+        self.budget = RetryBudget(budget)
+
+    def call(self, func, *args, idempotent=True, **kwargs):
+        self.budget.deposit()
+        for attempt in range(1, self.tries + 1):
+            self.limiter.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise
+            else:
+                delay = self._retry_delay(result, attempt, idempotent)
+                if delay is None:
+                    return result
+            time.sleep(delay)
+
+    async def call_async(self, func, *args, idempotent=True, **kwargs):
+        """ Same as call(), for a coroutine function. """
+        self.budget.deposit()
+        for attempt in range(1, self.tries + 1):
+            await self.limiter.acquire_async()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise
+            else:
+                delay = self._retry_delay(result, attempt, idempotent)
+                if delay is None:
+                    return result
+            await asyncio.sleep(delay)
+
+    def _retry_delay(self, outcome, attempt, idempotent=True):
+        """ How long to wait before trying again, or None if the outcome should be returned (or raised) as is. """
+        if isinstance(outcome, Exception):
+            if not is_retryable(outcome):
+                return None
+        elif status_of(outcome) not in RETRY_STATUSES:
+            return None
+        if not idempotent and status_of(outcome) != 429:
+            # the request may well have gone through, and doing it twice isn't safe
+            return None
+        if attempt >= self.tries or not self.budget.withdraw():
+            log.warning(f'Giving up on request to {self.name} after {attempt} attempts.')
+            return None
+
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        wait = retry_after(outcome)
+        if wait is not None:
+            # holds off every caller, including this one once it goes back to the limiter
+            self.limiter.pause(wait)
+        log.info(f'Request to {self.name} failed ({status_of(outcome) or outcome}), '
+                 f'retrying in {max(delay, wait or 0):.1f}s....')
+        return delay
+
+    def __repr__(self):
+        return f'<Upstream: {self.name}>'
+
+
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(name):
+    """ Return the process-wide Upstream for `name` ('jikan', 'tvdb' or 'mal'), creating it on first use. """
+    with _upstreams_lock:
+        if name not in _upstreams:
+            settings = dict(DEFAULT_LIMITS.get(name, {}), **(_limits_config.get(name) or {}))
+            _upstreams[name] = Upstream(name, **settings)
+        return _upstreams[name]
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+"""
+Webhook ingress for Plex. Webhooks are acknowledged as soon as they're
+written to a durable queue, which a pool of worker threads drains, since
+Plex gives up on receivers that take too long to respond.
+"""
+
+# builtins
+import argparse
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from functools import partial
+
+# 3rd party
+from flask import Flask, request, jsonify
+from cheroot.wsgi import Server as WSGIServer, PathInfoDispatcher
+
+# my modules
+from mal_automaton import config
+from mal_automaton.account import AccountPool, ConfigurationError
+from mal_automaton.cache import DEFAULT_PATH
+from mal_automaton.durable_queue import DurableQueue
+from mal_automaton.enums import PlexEvent
+from mal_automaton.plex import PlexWebhook, WebhookFilter
+from mal_automaton.translate import tvdb_to_mal
+from mal_automaton.utils import loads
+
+
+log = logging.getLogger(__name__)
+
+_server_config = config.get('server') or {}
+
+
+def handle_webhook(payload, accounts=None):
+    """
+    Resolve a webhook to a MAL episode, and if it was a scrobble, mark it as
+    watched on the MAL account of the Plex user it came from. Raises if the
+    update to MAL didn't go through, or returns a Future of whether it did if
+    the account batches its updates.
+    """
+    webhook = PlexWebhook(payload)
+    results = tvdb_to_mal(webhook)
+    if not results:
+        log.info("No MAL equivalent found")
+        return None
+
+    log.info(f"MAL ID was determined to be: {results['mal_id']}")
+    account = accounts.get(webhook.user.id) if accounts is not None else None
+    if account is None:
+        log.info(f"No MAL account for Plex user '{webhook.user.name}'.")
+    elif webhook.event is PlexEvent.scrobble:
+        updated = account.watch_episode(results['mal_id'], results['episode'])
+        if updated is False:
+            # raise, so the webhook stays queued and is retried later
+            raise RuntimeError(f"Failed to update MAL for {results['mal_id']}.")
+        return updated
+    return None
+
+
+class WebhookProcessor(object):
+    """
+    Hands webhook payloads to a pool of worker threads that each call
+    `handler(payload)`. Payloads go through a DurableQueue, so they're on disk
+    before the webhook is acknowledged, survive restarts, and are only removed
+    once the handler succeeds. A handler can also return a Future, in which
+    case the payload stays claimed (without holding up the worker) until the
+    Future resolves, and fails if it resolves to False. Payloads that fail
+    with a ConfigurationError are given up on straight away, since retrying
+    won't help. Workers start at most one payload every `interval` seconds
+    between them, to stay under upstream rate limits. When the queue is full,
+    new webhooks are dropped (and counted).
+    """
+    def __init__(self, handler, webhooks, *, workers=2, interval=0):
+        self.handler = handler
+        self.queue = webhooks
+        self.interval = interval
+        self.stats = Counter(received=0, processed=0, failed=0, dropped=0)
+        self._stats_lock = threading.Lock()
+        self._pace_lock = threading.Lock()
+        self._next_start = 0
+        self._stopping = threading.Event()
+        self._workers = [threading.Thread(target=self._work, name=f'webhook-worker-{i}', daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        # anything left over from the last run gets replayed first
+        self.queue.recover()
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        """ Shut the workers down once they finish what they're working on. """
+        self._stopping.set()
+        self.queue.wake()
+        for worker in self._workers:
+            worker.join()
+
+    def submit(self, payload):
+        """ Queue a webhook payload, returning False if it had to be dropped. """
+        self._count('received')
+        try:
+            self.queue.put(payload)
+        except queue.Full:
+            log.warning('Webhook queue is full, dropping webhook.')
+            self._count('dropped')
+            return False
+        return True
+
+    def _work(self):
+        while not self._stopping.is_set():
+            item = self.queue.get(timeout=1)
+            if item is None:
+                continue
+            id, payload = item
+            self._pace()
+            try:
+                result = self.handler(payload)
+            except ConfigurationError as e:
+                log.error(f'Giving up on webhook: {e}')
+                self._finish(id, False, permanent=True)
+            except Exception:
+                log.exception('Failed to process webhook.')
+                self._finish(id, False)
+            else:
+                if isinstance(result, Future):
+                    # e.g. a batched update to MAL, the webhook is done once that's been sent
+                    result.add_done_callback(partial(self._settle, id))
+                else:
+                    self._finish(id, True)
+
+    def _settle(self, id, future):
+        if future.exception() is not None:
+            log.error(f'Failed to process webhook: {future.exception()}')
+        elif future.result() is False:
+            log.error('Failed to process webhook: the update to MAL was given up on.')
+        self._finish(id, future.exception() is None and future.result() is not False)
+
+    def _finish(self, id, succeeded, permanent=False):
+        if succeeded:
+            self.queue.done(id)
+            self._count('processed')
+        else:
+            self.queue.fail(id, permanent=permanent)
+            self._count('failed')
+
+    def _pace(self):
+        """ Wait until it's this worker's turn to start on a payload. """
+        with self._pace_lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    @property
+    def depth(self):
+        return self.queue.depth
+
+    def status(self):
+        with self._stats_lock:
+            status = dict(self.stats)
+        status.update(depth=self.depth, max_depth=self.queue.max_depth,
+                      given_up=self.queue.count(DurableQueue.FAILED))
+        return status
+
+
+def create_app(processor, webhook_filter=None):
+    app = Flask(__name__)
+    webhook_filter = webhook_filter or WebhookFilter()
+
+    @app.route('/', methods=['POST'])
+    def ingest():
+        try:
+            payload = loads(request.form['payload'])
+        except (KeyError, ValueError):
+            return "Bad webhook", 400
+
+        if not webhook_filter(payload):
+            return "Ignored"
+        if not processor.submit(payload):
+            # Plex sends it again later, and that one shouldn't be coalesced away
+            webhook_filter.forget(payload)
+            return "Queue full", 503
+        return "OK"
+
+    @app.route('/status', methods=['GET'])
+    def status():
+        return jsonify(dict(processor.status(), **webhook_filter.stats))
+
+    return app
+
+
+def get_accounts():
+    """
+    The MAL accounts from the config: one per Plex user under 'accounts',
+    and the account in the 'mal' section itself for everyone else.
+    """
+    mal_config = config.get('mal') or {}
+    default = mal_config if mal_config.get('username') else None
+    accounts = AccountPool(mal_config.get('accounts') or {}, default)
+    if default is None and not accounts.credentials:
+        log.warning('No MAL account configured, matches will only be logged.')
+    return accounts
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-m',
+        '--netmask',
+        help='Netmask for the server to listen on',
+        default=_server_config.get('netmask', '127.0.0.1'),
+    )
+    parser.add_argument(
+        '-p',
+        '--port',
+        help='Port to listen on',
+        type=int,
+        default=_server_config.get('port', 8088),
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='Number of threads processing webhooks',
+        type=int,
+        default=_server_config.get('workers', 2),
+    )
+    parser.add_argument(
+        '-q',
+        '--max-depth',
+        help='Maximum number of webhooks waiting to be processed',
+        type=int,
+        default=_server_config.get('max_depth', 1000),
+    )
+    parser.add_argument(
+        '-i',
+        '--interval',
+        help='Minimum seconds between starting on webhooks, to respect rate limits',
+        type=float,
+        default=_server_config.get('interval', 1),
+    )
+    parser.add_argument(
+        '--queue',
+        help='SQLite file the webhook queue is kept in',
+        default=_server_config.get('queue_path', DEFAULT_PATH),
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_args()
+    webhooks = DurableQueue(args.queue, max_depth=args.max_depth)
+    accounts = get_accounts()
+    processor = WebhookProcessor(partial(handle_webhook, accounts=accounts), webhooks,
+                                 workers=args.workers, interval=args.interval)
+    processor.start()
+    app = create_app(processor)
+
+    d = PathInfoDispatcher({"/": app})
+    server = WSGIServer((args.netmask, args.port), d)
+    try:
+        log.info(f"Listening on {args.netmask}:{args.port}....")
+        server.start()
+    except KeyboardInterrupt:
+        log.info("Exiting....")
+        server.stop()
+        processor.stop()
+        # send any list updates still waiting in the write-behind queues
+        accounts.close()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,30 @@
 
 # builtins
 import logging
-from datetime import timedelta
 
 # my modules
+from mal_automaton import config
+from mal_automaton.cache import get_cache, cache_key
 from mal_automaton.utils import pretty_print
 from mal_automaton.mal import MAL_Franchise
 
 
 log = logging.getLogger(__name__)
 
+_matching_config = config.get('matching') or {}
+# minimum score for a fuzzy episode title match to be accepted
+TITLE_THRESHOLD = _matching_config.get('title_threshold', 0.6)
+# how long (in seconds) a TVDB -> MAL episode match is remembered
+MAPPING_TTL = _matching_config.get('mapping_ttl', 90 * 24 * 60 * 60)
+# how long (in seconds) an episode that couldn't be matched is skipped for
+NEGATIVE_TTL = _matching_config.get('negative_ttl', 24 * 60 * 60)
+# after this many unmatched episodes (and no matches), the whole series is skipped
+NEGATIVE_SERIES_THRESHOLD = _matching_config.get('negative_series_threshold', 3)
 
-def one_day_apart(airdate, episode):
-    """Compares 2 dates, returns if the difference < 1 day"""
-    delta = timedelta(days=1, seconds=1)
-    if not airdate or not episode.airdate:   # if airdate in MAL is null, abort
-        return False
-    log.debug(f"{episode.title} - mal: {episode.airdate}; tvdb: {airdate}")
-    return abs(episode.airdate - airdate) < delta
+# Plex libraries to process / ignore, by name
+_library_config = config.get('libraries') or {}
+ALLOWED_LIBRARIES = _library_config.get('allow') or []
+DENIED_LIBRARIES = _library_config.get('deny') or []
 
 
 def tvdb_to_mal(webhook):
@@ -27,38 +34,134 @@ def tvdb_to_mal(webhook):
     specified in the webhook. Plex references everything by TVDB identifiers,
     so we essentially scrape for some identifying information from TVDB and use
     that to match to an episode in MAL.
+
+    Results (and failures to find one) are remembered per TVDB episode, so
+    later webhooks for the same episode are answered locally without any
+    requests. Webhooks from libraries that aren't processed, and for
+    anything other than an episode (e.g. movies), are skipped.
     """
+    media = webhook.media
+    if media.media_type is not media.MediaType.Episode:
+        log.info(f"Skipping {media.media_type.value} from '{media.library_title}', only episodes can be matched.")
+        return False
+    if not library_allowed(media):
+        log.info(f"Skipping '{media.title}', library '{media.library_title}' isn't processed.")
+        return False
+    if cached_miss(media):
+        log.info(f"Skipping '{media.title}', no MAL match was found for it recently.")
+        return False
+    result = cached_mapping(media)
+    if result:
+        log.info(f"Using cached MAL match for '{media.title}': {result}")
+        return result
 
     # try to get franchise based on tvdb show title
-    franchise = MAL_Franchise(name=webhook.media.series)
+    try:
+        franchise = MAL_Franchise(name=media.series)
+    except IndexError:
+        # the search came back empty
+        log.info(f"No MAL series found for '{media.series}'.")
+        store_miss(media)
+        return False
+    remember_franchise(franchise)
 
-    # check all seasons for the given episode
-    log.info(f"Episode to find is '{webhook.media.title}'.")
-    for series in franchise.series:
-        log.info(f"Checking {series.title}....")
+    result = match_episode(franchise, media)
+    if result:
+        store_mapping(media, franchise, result)
+    else:
+        store_miss(media)
+    return result
 
-        # get all episodes for the series
-        log.debug('Episodes:')
-        pretty_print(series.episodes, debug=True)
 
-        filtered = [ep for ep in series.episodes if one_day_apart(webhook.media.airdate, ep)]
+def library_allowed(media):
+    """ Whether webhooks from this Plex library should be processed at all. """
+    if ALLOWED_LIBRARIES and media.library_title not in ALLOWED_LIBRARIES:
+        return False
+    return media.library_title not in DENIED_LIBRARIES
+
+
+def match_episode(franchise, media):
+    """ Find the MAL equivalent of a TVDB episode within the given franchise. """
+    # look up every episode in the franchise that aired around the same time
+    log.info(f"Episode to find is '{media.title}'.")
+    if media.airdate:
+        candidates = franchise.episodes_aired_near(media.airdate)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Candidates by airdate:')
+            pretty_print(candidates, debug=True)
+
+        if candidates:
+            # closest airdate wins
+            episode = candidates[0]
+            log.info(f"MAL Series is {episode.series}")
+            log.info(f"MAL Episode is {episode}")
+            return {'mal_id': episode.series.id, 'episode': episode.id, 'score': 1.0}
+
+    log.info('No episode found by airdate, trying by name....')
+    episode, score = franchise.episode_titled(media.title, TITLE_THRESHOLD)
+    if episode:
+        log.info(f"MAL Series is {episode.series}")
+        log.info(f"MAL Episode is {episode} (title match score {score:.2f})")
+        return {'mal_id': episode.series.id, 'episode': episode.id, 'score': score}
 
-        # log.debug(f'Filtered:')
-        # pretty_print(filtered, debug=True)
-        if filtered:
-            log.info(f"MAL Series is {series}")
-            log.info(f"MAL Episode is {filtered[0]}")
-            return {'mal_id': series.id, 'episode': filtered[0].id}
+    return False
 
-        log.info('No episode found by airdate, trying by name....')
-        filtered = [ep for ep in series.episodes if webhook.media.title == ep.title]
 
-        if filtered:
-            log.info(f"MAL Series is {series}")
-            log.info(f"MAL Episode is {filtered[0]}")
-            return {'mal_id': series.id, 'episode': filtered[0].id}
+def _mapping_key(media):
+    return cache_key('tvdb', media.tvdb_id, media.season, media.episode)
 
-    return False
+
+def remember_franchise(franchise):
+    """ Record the current shape of a franchise, which invalidates mappings made against an older one. """
+    get_cache('franchises').set(str(franchise.id), franchise.fingerprint)
+
+
+def cached_mapping(media):
+    """ Return the stored MAL match for a TVDB episode, if there is one and its franchise hasn't changed. """
+    if media.tvdb_id is None:
+        return None
+    mapping = get_cache('mappings').get(_mapping_key(media))
+    if mapping is None:
+        return None
+    if get_cache('franchises').get(str(mapping['franchise'])) != mapping['fingerprint']:
+        log.debug(f"Franchise {mapping['franchise']} has changed, ignoring cached match.")
+        return None
+    return mapping['result']
+
+
+def store_mapping(media, franchise, result):
+    if media.tvdb_id is None:
+        return
+    mapping = {'franchise': franchise.id, 'fingerprint': franchise.fingerprint, 'result': result}
+    get_cache('mappings').set(_mapping_key(media), mapping, ttl=MAPPING_TTL)
+    # the series clearly is on MAL, so forget any misses for it
+    get_cache('misses').delete(cache_key('count', 'tvdb', media.tvdb_id))
+
+
+def cached_miss(media):
+    """ Whether this episode (or its whole series) recently failed to match anything on MAL. """
+    if media.tvdb_id is None:
+        return False
+    misses = get_cache('misses')
+    return bool(misses.get(cache_key('tvdb', media.tvdb_id)) or misses.get(_mapping_key(media)))
+
+
+def store_miss(media):
+    """
+    Remember that an episode couldn't be matched. Once enough episodes of a
+    series have missed, the whole series is skipped for a while.
+    """
+    if media.tvdb_id is None:
+        return
+    misses = get_cache('misses')
+    misses.set(_mapping_key(media), True, ttl=NEGATIVE_TTL)
+
+    counter = cache_key('count', 'tvdb', media.tvdb_id)
+    count = (misses.get(counter) or 0) + 1
+    misses.set(counter, count, ttl=NEGATIVE_TTL)
+    if count >= NEGATIVE_SERIES_THRESHOLD:
+        log.info(f"Skipping '{media.series}' for a while, none of its episodes match anything on MAL.")
+        misses.set(cache_key('tvdb', media.tvdb_id), True, ttl=NEGATIVE_TTL)
 
 
 def get_absolute_episode(index: int, ep_list: list):
@@ -9,7 +9,20 @@ from dateutil.parser import isoparse
 from dateutil.tz import UTC
 
 # my modules
+from mal_automaton.cache import get_name_cache
 from mal_automaton.memoizer import memento_factory
+from mal_automaton.ratelimit import get_upstream
+
+
+def _request(func, *args, **kwargs):
+    """ Make a TVDB request through the shared rate limiter (and retry it if it fails). """
+    return get_upstream('tvdb').call(func, *args, **kwargs)
+
+
+def _all_episodes(listing):
+    """ Fetch every page of a Series_Episodes listing, each page as its own request. """
+    pages = _request(listing.pages)
+    return [ep for page in range(1, pages + 1) for ep in _request(listing.page, page)]
 
 
 def TVDB_SeriesIDFactory(cls, *args, **kwargs):
@@ -20,11 +33,14 @@ def TVDB_SeriesIDFactory(cls, *args, **kwargs):
     on init parameters (default mementos behavior)
     """
     def series_memo_identifier(id=None, *, name=None):
-        search = tvdb.Search()
+        names = get_name_cache('tvdb')
         if id:
             tvdb_id = id
         elif name:
-            tvdb_id = search.series(name)[0]['id']
+            tvdb_id = names.get(name)
+            if tvdb_id is None:
+                tvdb_id = _request(tvdb.Search().series, name)[0]['id']
+                names.set(name, tvdb_id)
         else:
             raise ValueError('You must specify an ID or name.')
         return tvdb_id
@@ -33,93 +49,169 @@ def TVDB_SeriesIDFactory(cls, *args, **kwargs):
 
 
 def TVDB_SeasonIDFactory(cls, *args, **kwargs):
-    def season_memo_identifier(series, number, episodes):
+    def season_memo_identifier(series, number, episodes=None):
         return (series, number)
 
     return season_memo_identifier(*args, **kwargs)
 
 
 def TVDB_EpisodeIDFactory(cls, *args, **kwargs):
-    def episode_memo_identifier(series, season, id):
-        return (series, season, id)
+    def episode_memo_identifier(series, season, data):
+        return (series, season, data['id'])
 
     return episode_memo_identifier(*args, **kwargs)
 
 
-TVDB_SeriesMemoizer = memento_factory('TVDB_SeriesMemoizer', TVDB_SeriesIDFactory, use_key=True)
-TVDB_SeasonMemoizer = memento_factory('TVDB_SeasonMemoizer', TVDB_SeasonIDFactory)
-TVDB_EpisodeMemoizer = memento_factory('TVDB_EpisodeMemoizer', TVDB_EpisodeIDFactory)
+TVDB_SeriesMemoizer = memento_factory('TVDB_SeriesMemoizer', TVDB_SeriesIDFactory, use_key=True,
+                                      maxsize=256, ttl=24 * 60 * 60)
+TVDB_SeasonMemoizer = memento_factory('TVDB_SeasonMemoizer', TVDB_SeasonIDFactory, maxsize=1024)
+TVDB_EpisodeMemoizer = memento_factory('TVDB_EpisodeMemoizer', TVDB_EpisodeIDFactory, maxsize=10000)
 
 
 class TVDB_Series(object, metaclass=TVDB_SeriesMemoizer):
     def __init__(self, id=None, *, name=None):
         self.id = id
-        self._raw = tvdb.Series(self.id)
-        self._raw.info()
-        self.series_id = self._raw.seriesId
-        self.title = self._raw.seriesName
-        self.language = self._raw.language   # TODO: enum
-        self.aliases = self._raw.aliases
-        self.status = self._raw.status   # TODO: enum
-        self.rating = self._raw.rating   # TODO: enum
-        self.network = self._raw.network
-        self.runtime = self._raw.runtime
-        self.airtime = self._raw.airsTime
-        self.airday = self._raw.airsDayOfWeek
-        self.genres = self._raw.genre   # TODO: enum
-        self.overview = self._raw.overview
-        self.imdb_id = self._raw.imdbId
-        self.zap2it_id = self._raw.zap2itId
-        self.slug = self._raw.slug
+        # only the parsed fields are kept (see raw)
+        raw = _request(tvdb.Series(self.id).info)
+        self.series_id = raw.get('seriesId')
+        self.title = raw.get('seriesName')
+        self.language = raw.get('language')   # TODO: enum
+        self.aliases = raw.get('aliases')
+        get_name_cache('tvdb').learn(self.id, self.title, *(self.aliases or []))
+        self.status = raw.get('status')   # TODO: enum
+        self.rating = raw.get('rating')   # TODO: enum
+        self.network = raw.get('network')
+        self.runtime = raw.get('runtime')
+        self.airtime = raw.get('airsTime')
+        self.airday = raw.get('airsDayOfWeek')
+        self.genres = raw.get('genre')   # TODO: enum
+        self.overview = raw.get('overview')
+        self.imdb_id = raw.get('imdbId')
+        self.zap2it_id = raw.get('zap2itId')
+        self.slug = raw.get('slug')
         self._seasons = None
 
     @property
     def seasons(self):
+        """ All seasons of the series. This downloads every episode, so prefer season() when possible. """
         if self._seasons:
             return self._seasons
 
-        self._raw.Episodes.all()
-        _episodes = sorted(self._raw.Episodes.episodes, key=lambda ep: ep['airedSeason'])
+        _episodes = sorted(_all_episodes(tvdb.Series_Episodes(self.id)), key=lambda ep: ep['airedSeason'])
         _seasons = {key: list(group) for key, group in groupby(_episodes, lambda ep: ep['airedSeason'])}
-        # convert to Season objects
-        self._seasons = {num: TVDB_Season(self, num, eps) for num, eps in _seasons.items()}
+        # convert to Season objects, filling in any that were already loaded lazily
+        self._seasons = {}
+        for num, eps in _seasons.items():
+            season = TVDB_Season(self, num, eps)
+            if not season.loaded:
+                season.load(eps)
+            self._seasons[num] = season
         return self._seasons
 
+    @property
+    def raw(self):
+        """ The full TVDB series record. It isn't kept around, so this fetches it again. """
+        return _request(tvdb.Series(self.id).info)
+
+    def season(self, number):
+        """ Get a single season, without loading the rest of the series. """
+        if self._seasons:
+            return self._seasons[number]
+        return TVDB_Season(self, number)
+
+    def episode(self, season, number):
+        """ Get a single episode, fetching only that episode if its season isn't loaded yet. """
+        return self.season(season).episode(number)
+
     @property
     def specials(self):
-        return self.seasons[0]
+        return self.season(0)
 
     def __repr__(self):
         return f"<TVDB_Series: {self.title}>"
 
 
 class TVDB_Season(object, metaclass=TVDB_SeasonMemoizer):
-    def __init__(self, series, number, episodes):
+    """
+    A season of a series. If it isn't given its episode records up front, they
+    are fetched (for this season only) the first time they're needed.
+    """
+    def __init__(self, series, number, episodes=None):
         self.series = series
         self.number = number
-        self.episodes = {}
-        for ep in episodes:
-            self.episodes[ep['airedEpisodeNumber']] = TVDB_Episode(self.series, self, ep['id'])
+        self._episodes = None
+        if episodes is not None:
+            self.load(episodes)
+
+    @property
+    def loaded(self):
+        return self._episodes is not None
+
+    @property
+    def episodes(self):
+        if not self.loaded:
+            self.load(_all_episodes(tvdb.Series_Episodes(self.series.id, airedSeason=self.number)))
+        return self._episodes
+
+    def load(self, episodes):
+        """ Build the episodes of this season from their basic episode records. """
+        self._episodes = {ep['airedEpisodeNumber']: TVDB_Episode(self.series, self, ep) for ep in episodes}
+
+    def episode(self, number):
+        """ Get a single episode, querying for just that one if the season isn't loaded. """
+        if self.loaded:
+            return self._episodes[number]
+        found = _all_episodes(tvdb.Series_Episodes(self.series.id, airedSeason=self.number, airedEpisode=number))
+        if not found:
+            raise KeyError(number)
+        return TVDB_Episode(self.series, self, found[0])
 
     def __repr__(self):
         return f"<TVDB_Season: {self.series.title} S{self.number:02}>"
 
 
 class TVDB_Episode(object, metaclass=TVDB_EpisodeMemoizer):
-    def __init__(self, series, season, id):
-        self.id = id
+    """
+    An episode, built from the basic record returned by the series' episode
+    listing. Fields missing from that record are fetched with an extra
+    Episode.info() request the first time they're accessed. The records
+    themselves aren't kept, since lots of episodes end up cached, only the
+    detail fields they happen to have.
+    """
+    # the memoizer needs the weakref slot
+    __slots__ = ('id', 'series', 'season', 'number', 'absolute', 'title', 'airdate', 'overview', '_details',
+                 '__weakref__')
+    # fields that are only in the full episode info
+    _detail_fields = ('contentRating', 'directors')
+
+    def __init__(self, series, season, data):
+        self.id = data['id']
         self.series = series
         self.season = season
-        self._raw = tvdb.Episode(id)
-        self._raw.info()
-
-        self.number = self._raw.airedEpisodeNumber
-        self.absolute = self._raw.absoluteNumber
-        self.title = self._raw.episodeName
-        self.airdate = isoparse(self._raw.firstAired).astimezone(UTC)
-        self.rating = self._raw.contentRating   # TODO: enum
-        self.overview = self._raw.overview
-        self.directors = self._raw.directors
+        # None rather than an empty dict, since most listings don't have any of them
+        self._details = {field: data[field] for field in self._detail_fields if field in data} or None
+
+        self.number = data['airedEpisodeNumber']
+        self.absolute = data.get('absoluteNumber')
+        self.title = data.get('episodeName')
+        self.airdate = isoparse(data['firstAired']).astimezone(UTC) if data.get('firstAired') else None
+        self.overview = data.get('overview')
+
+    @property
+    def rating(self):
+        return self._field('contentRating')   # TODO: enum
+
+    @property
+    def directors(self):
+        return self._field('directors')
+
+    def _field(self, name):
+        """ Get a field from the listing record, or the full episode info if it wasn't in there. """
+        details = self._details or {}
+        if name not in details:
+            info = _request(tvdb.Episode(self.id).info)
+            self._details = dict({field: info.get(field) for field in self._detail_fields}, **details)
+        return self._details[name]
 
     def __repr__(self):
         return f"<TVDB_Episode: {self.series.title} S{self.season.number:02}E{self.number:02}>"
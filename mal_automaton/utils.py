@@ -1,48 +1,61 @@
 #!/usr/bin/env python3
 
 # buitlins
+import json
 import logging
 
+# 3rd party
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = None
+
 
 log = logging.getLogger(__name__)
 
 
-def retry(tries=1):
+def loads(data):
     """
-    Decorator to retry something a certain amount of times. A function using
-    this decorator should signal failure via an exception. The resulting
-    exception will be raised upon failure of the final try.
+    Decode JSON from a str or bytes, with orjson or ujson if one of them is
+    installed, or the json module otherwise. Decoding errors are ValueErrors
+    either way.
     """
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            counter = 0
-            while counter < tries:
-                try:
-                    return func(*args, **kwargs)
-                except Exception:
-                    counter += 1
-                    if counter >= counter:
-                        raise
-        return wrapper
-    return decorator
-
-
-class AttrDict(object):
+    if fast_json is not None:
+        return fast_json.loads(data)
+    return json.loads(data)
+
+
+class AttrView(object):
     """
-    This class simply converts a dict to an equivalent object that uses dot
-    attribute notation instead of dictionary notation (object.attribute instead
-    of object['attribute']). Only converts dicts, and will recurse down to
-    nested dicts and convert them too (and also skip down past lists).
+    Read-only view of a dict that uses dot attribute notation instead of
+    dictionary notation (object.attribute instead of object['attribute']).
+    Nothing is copied: nested dicts (including those inside lists) are only
+    wrapped in another view when they're accessed.
     """
+    __slots__ = ('_data',)
+
     def __init__(self, _dict):
-        for key, value in _dict.items():
-            if isinstance(value, dict):
-                self.__dict__.update({key: AttrDict(value)})
-            elif isinstance(value, list):
-                # to continue recursing past lists
-                self.__dict__.update({key: [AttrDict(i) for i in value]})
-            else:
-                self.__dict__.update({key: value})
+        self._data = _dict
+
+    @staticmethod
+    def wrap(value):
+        if isinstance(value, dict):
+            return AttrView(value)
+        if isinstance(value, list):
+            return [AttrView.wrap(i) for i in value]
+        return value
+
+    def __getattr__(self, key):
+        try:
+            return self.wrap(self._data[key])
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __repr__(self):
+        return f'<AttrView: {self._data!r}>'
 
 
 class GenericObject(object):
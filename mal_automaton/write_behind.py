@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""
+Write-behind for list updates. Scrobbles come in one episode at a time, but
+only the latest state of each series on the list matters, so updates are
+held for a little while, coalesced per series, and sent to MAL together.
+"""
+
+# builtins
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+# my modules
+from mal_automaton import config
+from mal_automaton.cache import Cache, DEFAULT_PATH, cache_key
+from mal_automaton.enums import WatchStatus
+
+
+log = logging.getLogger(__name__)
+
+_write_config = (config.get('mal') or {}).get('write_behind') or {}
+ENABLED = _write_config.get('enabled', True)
+# seconds between flushes
+FLUSH_INTERVAL = _write_config.get('interval', 60)
+# pending series that trigger a flush straight away
+MAX_PENDING = _write_config.get('max_pending', 20)
+# failed writes are given up on after this many flushes
+MAX_ATTEMPTS = _write_config.get('max_attempts', 5)
+JOURNAL_PATH = _write_config.get('journal_path', DEFAULT_PATH)
+
+
+def merge(earlier, later):
+    """
+    Coalesce two writes for the same series into one with the same end
+    result, or None if they cancel each other out.
+    """
+    if earlier is None:
+        return later
+    if earlier['action'] == 'add':
+        # the series isn't on MAL yet, so it still has to be added (or never was)
+        return None if later['action'] == 'delete' else dict(later, action='add')
+    if earlier['action'] == 'delete' and later['action'] == 'add':
+        # the series is still on MAL, so this is really an edit
+        return dict(later, action='edit')
+    return later
+
+
+class WriteBehind(object):
+    """
+    Sits in front of a MAL_Session, and takes its add_series(), edit_series()
+    and delete_series() calls. Writes are kept per series (coalesced into
+    the latest state), journaled to disk so they survive a crash, and sent
+    every `interval` seconds, or as soon as `max_pending` series are waiting.
+    Writes that fail are tried again on later flushes, up to `max_attempts`
+    times. Every flush returns (and passes to `on_flush`) a dict of MAL ID to
+    whether that write went through.
+
+    Every queued write returns a Future, which is resolved with True once the
+    write (or the later one it was coalesced into) has gone through, or with
+    False if it was given up on (or was still pending at close()). Once a
+    write has been sent, given up on, or cancelled out by a later write,
+    `on_settle(mal_id, write, written)` is called with it, where `written`
+    is whether the list on MAL ended up the way it was asked for.
+    """
+    def __init__(self, session, journal=None, *, interval=FLUSH_INTERVAL, max_pending=MAX_PENDING,
+                 max_attempts=MAX_ATTEMPTS, on_flush=None, on_settle=None):
+        self.session = session
+        self.journal = journal if journal is not None else Cache(JOURNAL_PATH, 'pending_writes', max_entries=None)
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.on_flush = on_flush
+        self.on_settle = on_settle
+        self.stats = Counter(queued=0, coalesced=0, flushes=0, written=0, failed=0, given_up=0)
+        self._pending = {}
+        self._waiters = {}   # MAL ID -> [Future] of the writes pending for it
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._recover()
+
+    def _key(self, mal_id):
+        return cache_key(self.session.username, mal_id)
+
+    def _recover(self):
+        """ Pick up writes that were still pending when the process last stopped. """
+        for key, write in self.journal.items(cache_key(self.session.username, '')):
+            self._pending[int(key.rsplit('/', 1)[1])] = write
+        if self._pending:
+            log.info(f'Recovered {len(self._pending)} pending list updates for {self.session.username}.')
+
+    def add_series(self, mal_id, status=WatchStatus.PlanToWatch, score=0, watched_episodes=0):
+        return self._queue(mal_id, 'add', status, score, watched_episodes)
+
+    def edit_series(self, mal_id, status=WatchStatus.Watching, score=0, watched_episodes=0):
+        return self._queue(mal_id, 'edit', status, score, watched_episodes)
+
+    def delete_series(self, mal_id):
+        return self._queue(mal_id, 'delete')
+
+    def _queue(self, mal_id, action, status=None, score=0, watched_episodes=0):
+        write = {'action': action, 'status': status and status.value, 'score': score,
+                 'watched_episodes': watched_episodes, 'attempts': 0}
+        future = Future()
+        with self._lock:
+            self.stats['queued'] += 1
+            if mal_id in self._pending:
+                self.stats['coalesced'] += 1
+            merged = merge(self._pending.get(mal_id), write)
+            self._store(mal_id, merged)
+            waiters = self._waiters.setdefault(mal_id, [])
+            waiters.append(future)
+            if merged is None:
+                # cancelled out, so there's nothing left to send
+                del self._waiters[mal_id]
+            elif len(self._pending) >= self.max_pending:
+                self._wake.set()
+        if merged is None:
+            self._settle(mal_id, write, waiters, True)
+        return future
+
+    def _settle(self, mal_id, write, futures, written):
+        # outside the lock, since the callbacks run right here
+        for future in futures:
+            future.set_result(written)
+        if self.on_settle is not None:
+            self.on_settle(mal_id, write, written)
+
+    def _store(self, mal_id, write):
+        """ Set (or with None, drop) the pending write for a series, in memory and in the journal. """
+        if write is None:
+            self._pending.pop(mal_id, None)
+            self.journal.delete(self._key(mal_id))
+        else:
+            self._pending[mal_id] = write
+            self.journal.set(self._key(mal_id), write)
+
+    def flush(self):
+        """ Send every pending write to MAL now, returning a dict of MAL ID to whether it went through. """
+        with self._flush_lock:
+            with self._lock:
+                writes, self._pending = self._pending, {}
+                waiters, self._waiters = self._waiters, {}
+            results = {mal_id: self._send(mal_id, write, waiters.get(mal_id, [])) for mal_id, write in writes.items()}
+
+        if results:
+            self.stats['flushes'] += 1
+            log.info(f'Sent {len(results)} list updates to MAL for {self.session.username}: '
+                     f'{sum(results.values())} went through, {len(results) - sum(results.values())} failed.')
+            if self.on_flush is not None:
+                self.on_flush(results)
+        return results
+
+    def _send(self, mal_id, write, waiters):
+        try:
+            if write['action'] == 'delete':
+                ok = self.session.delete_series(mal_id)
+            else:
+                method = self.session.add_series if write['action'] == 'add' else self.session.edit_series
+                ok = method(mal_id, WatchStatus(write['status']), write['score'], write['watched_episodes'])
+        except Exception:
+            log.exception(f'Failed to send list update for {mal_id} to MAL.')
+            ok = False
+
+        with self._lock:
+            newer = self._pending.get(mal_id)
+            if ok:
+                self.stats['written'] += 1
+                if newer is None:
+                    self.journal.delete(self._key(mal_id))
+                written = True
+            else:
+                self.stats['failed'] += 1
+                written = self._retry(mal_id, write, newer, waiters)
+        if written is not None:
+            self._settle(mal_id, write, waiters, written)
+        return ok
+
+    def _retry(self, mal_id, write, newer, waiters):
+        """
+        Put a failed write back in line, under anything that was queued for
+        the series since. Returns None if it was, False if it was given up on
+        instead, or True if what was queued since cancelled it out (in which
+        case whoever was waiting on that is added to `waiters`).
+        """
+        write = dict(write, attempts=write['attempts'] + 1)
+        if newer is None and write['attempts'] >= self.max_attempts:
+            log.warning(f'Giving up on list update for {mal_id} after {write["attempts"]} attempts.')
+            self.stats['given_up'] += 1
+            self._store(mal_id, None)
+            return False
+        merged = merge(write, newer) if newer is not None else write
+        self._store(mal_id, merged)
+        if merged is None:
+            # e.g. an add that failed, and a delete since, so there's nothing left to send
+            waiters.extend(self._waiters.pop(mal_id, []))
+            return True
+        # whoever was waiting on the failed write now waits on the next try
+        self._waiters[mal_id] = waiters + self._waiters.get(mal_id, [])
+        return None
+
+    def start(self):
+        """ Start flushing in the background. """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f'write-behind-{self.session.username}',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        """
+        Stop flushing in the background, and send whatever is still pending.
+        Writes that still didn't go through stay in the journal for the next
+        run, but anyone waiting on them is told they haven't been made.
+        """
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        results = self.flush()
+        with self._lock:
+            waiters, self._waiters = self._waiters, {}
+        for futures in waiters.values():
+            for future in futures:
+                future.set_result(False)
+        return results
+
+    @property
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def __repr__(self):
+        return f'<WriteBehind: {self.session.username} [{len(self)}]>'
@@ -20,6 +20,11 @@ setuptools.setup(
     url="https://github.com/loganswartz/mal_automaton",
     packages=setuptools.find_packages(),
     install_requires=requirements,
+    extras_require={
+        'server': ['flask', 'cheroot'],
+        'async': ['aiohttp'],
+        'fast': ['orjson'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3.6",
         "Operating System :: POSIX :: Linux",
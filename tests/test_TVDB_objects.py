@@ -2,7 +2,7 @@
 
 import pytest
 import mal_automaton.memoizer
-from mal_automaton.tvdb import TVDB_Series
+from mal_automaton.tvdb import TVDB_Episode, TVDB_Series
 
 
 @pytest.fixture
@@ -26,3 +26,27 @@ class TestConstructors:
 # def test_series_memoization():
 #     assert TVDB_Series(267440) is TVDB_Series(name='Attack on Titan')
 
+
+def listed_episode(**fields):
+    """ A TVDB_Episode built from an episode listing record, without going through the memoizer. """
+    data = dict({'id': 1, 'airedEpisodeNumber': 1, 'episodeName': 'That Day', 'firstAired': '2019-04-28'}, **fields)
+    episode = TVDB_Episode.__new__(TVDB_Episode)
+    episode.__init__(None, None, data)
+    return episode
+
+
+def test_episode_fields_come_from_the_listing_first(monkeypatch):
+    requests = []
+
+    def info(func):
+        requests.append(func)
+        return {'contentRating': 'TV-14', 'directors': ['Someone']}
+
+    monkeypatch.setattr('mal_automaton.tvdb._request', info)
+    episode = listed_episode(directors=['Listed'])
+    assert episode.directors == ['Listed']
+    assert requests == []
+    assert episode.rating == 'TV-14'
+    assert episode.directors == ['Listed']
+    assert len(requests) == 1
+    assert listed_episode().directors == ['Someone']
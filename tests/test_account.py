@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import pytest
+import requests
+from mal_automaton.account import AccountPool, ConfigurationError, MAL_Account, MAL_Session, get_session_store
+from mal_automaton.animelist import AnimeListEntry
+from mal_automaton.cache import Cache
+from mal_automaton.enums import WatchStatus
+from mal_automaton.ratelimit import Upstream
+
+LOGIN_PAGE = "<meta name='csrf_token' content='{}'>"
+
+
+class FakeResponse:
+    def __init__(self, url, status_code=200, text=''):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.ok = status_code < 400
+
+
+class FakeRequests(requests.Session):
+    """ Pretends to be MAL: writes only go through with the token handed out at the last login. """
+    def __init__(self, valid_token=None):
+        super().__init__()
+        self.valid_token = valid_token
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(('GET', url))
+        return FakeResponse(url, text=LOGIN_PAGE.format('prelogin'))
+
+    def post(self, url, data=None, **kwargs):
+        self.requests.append(('POST', url))
+        if url.endswith('login.php'):
+            self.valid_token = 'fresh'
+            self.cookies.set('MALSESSIONID', 'abc', domain='myanimelist.net')
+            return FakeResponse('https://myanimelist.net/', text=LOGIN_PAGE.format('fresh'))
+        if data['csrf'] != self.valid_token:
+            return FakeResponse(url, 400, '{"errors":[{"message":"Invalid CSRF token."}]}')
+        return FakeResponse(url)
+
+
+@pytest.fixture(autouse=True)
+def sessions(monkeypatch):
+    cache = Cache(':memory:', 'mal_sessions')
+    monkeypatch.setattr('mal_automaton.account.get_session_store', lambda: cache)
+    monkeypatch.setattr('mal_automaton.ratelimit._upstreams', {'mal': Upstream('mal', rate=1000, burst=100)})
+    return cache
+
+
+def make_session(fake):
+    session = MAL_Session('someone', 'hunter2')
+    session.session = fake
+    return session
+
+
+def test_no_login_until_first_write():
+    fake = FakeRequests()
+    session = MAL_Session('someone', 'hunter2')
+    assert session.csrf_token is None
+    session.session = fake
+    assert fake.requests == []
+    assert session.edit_series(1)
+    assert [method for method, url in fake.requests] == ['GET', 'POST', 'POST']
+
+
+def test_session_is_reused(sessions):
+    first = make_session(FakeRequests())
+    first.edit_series(1)
+    assert sessions.get('someone')['csrf_token'] == 'fresh'
+
+    fake = FakeRequests(valid_token='fresh')
+    second = MAL_Session('someone', 'hunter2')
+    assert second.session.cookies.get('MALSESSIONID') == 'abc'
+    second.session = fake
+    assert second.edit_series(1)
+    assert fake.requests == [('POST', 'https://myanimelist.net/ownlist/anime/edit.json')]
+
+
+def test_logs_in_again_when_rejected(sessions):
+    sessions.set('someone', {'cookies': [], 'csrf_token': 'stale'})
+    fake = FakeRequests(valid_token='something else')
+    session = make_session(fake)
+    assert session.delete_series(1)
+    assert [method for method, url in fake.requests] == ['POST', 'GET', 'POST', 'POST']
+    assert session.csrf_token == 'fresh'
+
+
+def test_add_is_not_retried_when_mal_fails(sessions, monkeypatch):
+    monkeypatch.setattr('mal_automaton.ratelimit.time.sleep', lambda seconds: None)
+    sessions.set('someone', {'cookies': [], 'csrf_token': 'fresh'})
+    fake = FakeRequests(valid_token='fresh')
+    fake.post = lambda url, data=None, **kwargs: fake.requests.append(('POST', url)) or FakeResponse(url, 502)
+    session = make_session(fake)
+    assert not session.add_series(1)
+    assert len(fake.requests) == 1
+    # edits set the whole entry, so they're safe to send again
+    assert not session.edit_series(1)
+    assert len(fake.requests) == 5
+
+
+class FakeAccount:
+    def __init__(self, username, password=None):
+        self.username = username
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        return {}
+
+
+def test_account_pool_routes_by_plex_user(monkeypatch):
+    monkeypatch.setattr('mal_automaton.account.MAL_Account', FakeAccount)
+    alice, bob = {'username': 'alice', 'password': 'x'}, {'username': 'bob', 'password': 'y'}
+    pool = AccountPool({1: alice, '2': bob, 3: alice})
+    assert pool.get('1').username == 'alice'
+    assert pool.get(2).username == 'bob'
+    assert pool.get(3) is pool.get(1)
+    assert pool.get(4) is None
+    assert len(pool) == 2
+    assert AccountPool({}, default={'username': 'carol', 'password': 'z'}).get(4).username == 'carol'
+    pool.close()
+    assert pool.get(1).closed
+
+
+def test_account_without_password_is_a_configuration_error(monkeypatch):
+    monkeypatch.setattr('mal_automaton.account.MAL_Account', FakeAccount)
+    pool = AccountPool({1: {'username': 'alice'}})
+    with pytest.raises(ConfigurationError):
+        pool.get(1)
+    assert len(pool) == 0
+
+
+def test_sessions_share_connection_pool():
+    first, second = MAL_Session('a', 'x'), MAL_Session('b', 'y')
+    assert first.session.get_adapter('https://myanimelist.net') is second.session.get_adapter('https://myanimelist.net')
+    assert first.session.cookies is not second.session.cookies
+
+
+class FakeList:
+    def __init__(self, username):
+        self.refreshes = []
+        self.entries = {1: AnimeListEntry({'mal_id': 1, 'title': 'Series', 'type': 'TV', 'airing_status': 2,
+                                           'total_episodes': 12, 'watching_status': WatchStatus.Watching.value, 'score': 0,
+                                           'watched_episodes': 3})}
+
+    def refresh(self, full=False, *, skip=()):
+        self.refreshes.append(full)
+
+    def __contains__(self, mal_id):
+        return mal_id in self.entries
+
+    def __getitem__(self, mal_id):
+        return self.entries[mal_id]
+
+    def get(self, mal_id, default=None):
+        return self.entries.get(mal_id, default)
+
+    def add(self, entry):
+        self.entries[entry.id] = entry
+
+    def set_status(self, mal_id, status=None, *, score=None, watched_episodes=None):
+        self.entries[mal_id].status.watched_episodes = watched_episodes
+
+
+class FakeWriter:
+    def edit_series(self, mal_id, status, score, watched_episodes):
+        return True
+
+
+def test_stale_list_is_refreshed_before_watching(monkeypatch):
+    monkeypatch.setattr('mal_automaton.account.AnimeList', FakeList)
+    account = MAL_Account('someone', write_behind=False)
+    account.user = FakeWriter()
+    assert account.watch_episode(1, 4)
+    assert account.anime_list.refreshes == []
+    monkeypatch.setattr('mal_automaton.account.LIST_REFRESH', 0)
+    assert account.watch_episode(1, 5)
+    assert account.anime_list.refreshes == [False]
+    assert account.anime_list[1].status.watched_episodes == 5
+
+
+class FlakySession:
+    ok = False
+
+    def __init__(self, username, password):
+        self.username = username
+
+    def edit_series(self, mal_id, status, score, watched_episodes):
+        return self.ok
+
+
+def test_given_up_update_is_rolled_back(monkeypatch, tmp_path):
+    monkeypatch.setattr('mal_automaton.account.AnimeList', FakeList)
+    monkeypatch.setattr('mal_automaton.account.MAL_Session', FlakySession)
+    monkeypatch.setattr('mal_automaton.write_behind.JOURNAL_PATH', str(tmp_path / 'journal.db'))
+    account = MAL_Account('someone', 'hunter2')
+    try:
+        FlakySession.ok = True
+        assert account.watch_episode(1, 4)
+        account.writes.flush()
+        # failing from here on: the update to 5 was written locally, but never makes it to MAL
+        FlakySession.ok = False
+        updated = account.watch_episode(1, 5)
+        assert account.anime_list[1].status.watched_episodes == 5
+        while not updated.done():
+            account.writes.flush()
+        assert updated.result() is False
+        assert account.anime_list[1].status.watched_episodes == 4
+    finally:
+        account.close()
+
+
+def test_logins_are_kept_apart_and_private(monkeypatch, tmp_path):
+    monkeypatch.setattr('mal_automaton.account.SESSION_PATH', str(tmp_path / 'logins'))
+    monkeypatch.setattr('mal_automaton.account._sessions', None)
+    # not the in-memory store the other tests use
+    store = get_session_store()
+    store.set('someone', {'cookies': [], 'csrf_token': 'secret'})
+    assert store.path == str(tmp_path / 'logins')
+    assert (tmp_path / 'logins').stat().st_mode & 0o777 == 0o600
+
+
+def test_logins_can_be_forgotten(monkeypatch):
+    monkeypatch.setattr('mal_automaton.account.REMEMBER_LOGIN', False)
+    monkeypatch.setattr('mal_automaton.account._sessions', None)
+    assert get_session_store().path == ':memory:'
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import asyncio
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from mal_automaton import aio  # noqa: E402
+from mal_automaton.aio import AsyncCachedJikan  # noqa: E402
+from mal_automaton.api import CachedJikan  # noqa: E402
+from mal_automaton.cache import Cache  # noqa: E402
+from mal_automaton.ratelimit import Upstream  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def unlimited(monkeypatch):
+    # the fake APIs don't need rate limiting
+    monkeypatch.setattr('mal_automaton.ratelimit._upstreams', {'jikan': Upstream('jikan', rate=1000, burst=100)})
+
+
+class FakeAioJikan:
+    def __init__(self):
+        self.calls = []
+
+    async def anime(self, id, extension=None, page=None):
+        self.calls.append((id, extension, page))
+        await asyncio.sleep(0.01)
+        return {'mal_id': id, 'airing': False, 'request_cached': False}
+
+
+class OfflineJikan:
+    def anime(self, *args, **kwargs):
+        raise AssertionError('should have been served from the cache')
+
+
+@pytest.fixture
+def jikan():
+    jikan = AsyncCachedJikan(Cache(':memory:'))
+    jikan._jikan = FakeAioJikan()
+    return jikan
+
+
+def test_concurrent_requests_are_sent_once(jikan):
+    async def fetch():
+        return await asyncio.gather(*(jikan.anime(1) for _ in range(5)), jikan.anime(2))
+
+    results = asyncio.run(fetch())
+    assert [resp['mal_id'] for resp in results] == [1, 1, 1, 1, 1, 2]
+    assert sorted(jikan._jikan.calls) == [(1, None, None), (2, None, None)]
+
+
+def test_responses_are_shared_with_sync_wrapper(jikan):
+    asyncio.run(jikan.anime(1))
+    # the sync wrapper is answered from the cache the async one filled
+    resp = CachedJikan(jikan.cache, jikan=OfflineJikan()).anime(1)
+    assert resp['mal_id'] == 1
+    assert resp['request_cached'] is True
+
+
+def test_each_event_loop_gets_its_own_client(monkeypatch):
+    cache = Cache(':memory:')
+    monkeypatch.setattr('mal_automaton.aio.get_cache', lambda table, **kwargs: cache)
+    clients = []
+
+    async def use():
+        async with aio.session() as jikan:
+            assert aio.get_async_jikan() is jikan
+            await jikan._client()
+            clients.append((jikan, jikan._session))
+            jikan._jikan = FakeAioJikan()
+            return await jikan.anime(len(clients))
+
+    assert asyncio.run(use())['mal_id'] == 1
+    assert asyncio.run(use())['mal_id'] == 2
+    (first, first_session), (second, second_session) = clients
+    assert first is not second
+    assert first_session.closed and second_session.closed
+    # both loops filled the same response cache
+    assert cache.get('anime/1')['mal_id'] == 1
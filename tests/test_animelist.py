@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import pytest
+from mal_automaton.animelist import AnimeList
+from mal_automaton.api import CachedJikan
+from mal_automaton.cache import Cache
+from mal_automaton.enums import WatchStatus
+from mal_automaton.ratelimit import Upstream
+
+
+def entry(id, status, watched=0):
+    return {'mal_id': id, 'title': f'Series {id}', 'type': 'TV', 'airing_status': 2, 'total_episodes': 12,
+            'watching_status': status.value, 'score': 0, 'watched_episodes': watched}
+
+
+class FakeJikan:
+    def __init__(self, entries):
+        self.entries = entries
+        self.pages = []
+
+    def user(self, username, request=None, argument=None, page=None, parameters=None, fresh=False):
+        self.pages.append(page)
+        return {'anime': self.entries[(page - 1) * 2:page * 2]}
+
+
+@pytest.fixture
+def jikan(monkeypatch):
+    entries = [entry(1, WatchStatus.Watching, 3), entry(2, WatchStatus.Completed, 12), entry(3, WatchStatus.PlanToWatch)]
+    jikan = FakeJikan(entries)
+    monkeypatch.setattr('mal_automaton.animelist.get_jikan', lambda: jikan)
+    monkeypatch.setattr('mal_automaton.animelist.PAGE_SIZE', 2)
+    return jikan
+
+
+@pytest.fixture
+def anime_list(jikan):
+    return AnimeList('someone')
+
+
+def test_lookup_by_id(anime_list):
+    assert len(anime_list) == 3
+    assert 2 in anime_list
+    assert 4 not in anime_list
+    assert anime_list[1].status.watched_episodes == 3
+    assert anime_list[3] in anime_list
+    assert anime_list[3] == anime_list[3]
+    assert anime_list[3] != anime_list[1]
+    with pytest.raises(KeyError):
+        anime_list[4]
+
+
+def test_status_partitions(anime_list):
+    assert [e.id for e in anime_list.Watching] == [1]
+    assert [e.id for e in anime_list.Completed] == [2]
+    assert [e.id for e in anime_list.PTW] == [3]
+
+
+def test_set_status_moves_partition(anime_list):
+    anime_list.set_status(1, WatchStatus.Completed, watched_episodes=12)
+    assert [e.id for e in anime_list.Watching] == []
+    assert [e.id for e in anime_list.Completed] == [2, 1]
+    assert anime_list[1].status.watched_episodes == 12
+
+
+def test_remove(anime_list):
+    anime_list.remove(3)
+    assert 3 not in anime_list
+    assert list(anime_list.PTW) == []
+
+
+def test_loads_every_page(jikan, anime_list):
+    assert jikan.pages == [1, 2]
+    assert sorted(anime_list.entries) == [1, 2, 3]
+
+
+def test_quick_refresh_stops_at_unchanged_page(jikan, anime_list):
+    jikan.pages.clear()
+    jikan.entries[0] = entry(1, WatchStatus.Watching, 4)
+    assert anime_list.refresh() == {'added': 0, 'changed': 1, 'removed': 0}
+    assert anime_list[1].status.watched_episodes == 4
+    jikan.pages.clear()
+    anime_list.refresh()
+    assert jikan.pages == [1]
+
+
+def test_full_refresh_applies_deltas(jikan, anime_list):
+    unchanged = anime_list[2]
+    jikan.entries[:] = [jikan.entries[1], entry(4, WatchStatus.Watching, 1)]
+    assert anime_list.refresh(full=True) == {'added': 1, 'changed': 0, 'removed': 2}
+    assert sorted(anime_list.entries) == [2, 4]
+    assert anime_list[2] is unchanged
+
+
+def test_refresh_after_write_through_is_not_served_from_cache(monkeypatch, jikan):
+    monkeypatch.setattr('mal_automaton.ratelimit._upstreams', {'jikan': Upstream('jikan', rate=1000, burst=100)})
+    cached = CachedJikan(Cache(':memory:'), jikan=jikan)
+    monkeypatch.setattr('mal_automaton.animelist.get_jikan', lambda: cached)
+    anime_list = AnimeList('someone')
+    # the write went through to MAL, and was written through to the local list
+    jikan.entries[0] = entry(1, WatchStatus.Watching, 4)
+    anime_list.set_status(1, watched_episodes=4)
+    assert anime_list.refresh(full=True) == {'added': 0, 'changed': 0, 'removed': 0}
+    assert anime_list[1].status.watched_episodes == 4
+
+
+def test_refresh_skips_unsent_changes(jikan, anime_list):
+    anime_list.set_status(1, watched_episodes=5)
+    anime_list.remove(2)
+    jikan.entries.pop(2)
+    assert anime_list.refresh(full=True, skip={1}) == {'added': 1, 'changed': 0, 'removed': 1}
+    assert anime_list[1].status.watched_episodes == 5
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import pytest
+from mal_automaton.cache import Cache, NameCache, cache_key
+from mal_automaton.api import CachedJikan, TTL
+from mal_automaton.ratelimit import Upstream
+
+
+@pytest.fixture(autouse=True)
+def unlimited(monkeypatch):
+    # the fake APIs don't need rate limiting
+    monkeypatch.setattr('mal_automaton.ratelimit._upstreams', {'jikan': Upstream('jikan', rate=1000, burst=100)})
+
+
+@pytest.fixture
+def cache():
+    return Cache(':memory:', max_entries=3)
+
+
+class FakeJikan:
+    def __init__(self):
+        self.calls = []
+
+    def anime(self, id, extension=None, page=None):
+        self.calls.append((id, extension, page))
+        if extension:
+            return {'episodes': [], 'episodes_last_page': 1, 'request_cached': False}
+        return {'mal_id': id, 'airing': id == 1, 'request_cached': False}
+
+
+def test_cache_roundtrip(cache):
+    cache.set('a', {'value': 1})
+    assert cache.get('a') == {'value': 1}
+    assert cache.get('missing') is None
+
+
+def test_cache_expiry(cache):
+    cache.set('a', 1, ttl=-1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_cache_evicts_least_recently_used(cache):
+    for key in 'abc':
+        cache.set(key, key)
+    cache.get('a')
+    cache.set('d', 'd')
+    assert 'b' not in cache
+    assert all(key in cache for key in 'acd')
+
+
+def test_cache_key():
+    assert cache_key('anime', 16498, None, None) == 'anime/16498'
+    assert cache_key('anime', 16498, 'episodes', 2) == 'anime/16498/episodes/2'
+
+
+def test_cached_jikan():
+    fake = FakeJikan()
+    jikan = CachedJikan(Cache(':memory:'), fake)
+    assert jikan.anime(2)['request_cached'] is False
+    assert jikan.anime(2)['request_cached'] is True
+    assert fake.calls == [(2, None, None)]
+
+
+def test_cached_jikan_ttl():
+    jikan = CachedJikan(Cache(':memory:'), FakeJikan())
+    jikan.anime(1)
+    jikan.anime(2)
+    assert jikan._anime_ttl(1, {'episodes': []}) == TTL['airing']
+    assert jikan._anime_ttl(2, {'episodes': []}) == TTL['finished']
+    assert jikan._anime_ttl(3, {'episodes': []}) == TTL['airing']
+
+
+def test_name_cache():
+    names = NameCache(Cache(':memory:'))
+    assert names.get('Attack on Titan') is None
+    names.set('Attack on Titan', 16498)
+    names.learn(99, 'attack on titan', 'Shingeki no Kyojin', None, '')
+    assert names.get('ATTACK ON TITAN!') == 16498
+    assert names.get('Shingeki no Kyojin') == 99
+    assert names.stats == {'hits': 2, 'misses': 1}
+    assert names.hit_rate == 2 / 3
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import queue
+import pytest
+from mal_automaton.durable_queue import DurableQueue
+
+
+@pytest.fixture
+def webhooks(tmp_path):
+    return DurableQueue(tmp_path / 'queue.db', max_depth=3, max_attempts=2, retry_delay=0)
+
+
+def test_fifo(webhooks):
+    for i in range(3):
+        webhooks.put({'n': i})
+    assert [webhooks.get(timeout=0)[1]['n'] for _ in range(3)] == [0, 1, 2]
+    assert webhooks.get(timeout=0) is None
+
+
+def test_backpressure(webhooks):
+    for i in range(3):
+        webhooks.put({'n': i})
+    with pytest.raises(queue.Full):
+        webhooks.put({'n': 3})
+
+
+def test_done_and_fail(webhooks):
+    webhooks.put({'n': 0})
+    id, _ = webhooks.get(timeout=0)
+    webhooks.fail(id)
+    assert webhooks.get(timeout=0)[0] == id
+    webhooks.fail(id)
+    assert webhooks.get(timeout=0) is None
+    assert webhooks.count(DurableQueue.FAILED) == 1
+
+    webhooks.put({'n': 1})
+    id, _ = webhooks.get(timeout=0)
+    webhooks.done(id)
+    assert webhooks.depth == 0
+
+
+def test_recover_after_restart(tmp_path):
+    first = DurableQueue(tmp_path / 'queue.db')
+    first.put({'n': 0})
+    assert first.get(timeout=0) is not None
+
+    second = DurableQueue(tmp_path / 'queue.db')
+    assert second.get(timeout=0) is None
+    assert second.recover() == 1
+    assert second.get(timeout=0)[1] == {'n': 0}
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import pytest
+import threading
+from datetime import datetime, timedelta
+from dateutil.tz import UTC
+from mal_automaton.index import AirdateIndex, TitleIndex, normalize_title
+
+
+class FakeSeries:
+    def __init__(self, id, episodes):
+        self.id = id
+        self.episodes = [FakeEpisode(self, *ep) for ep in episodes]
+
+
+class FakeEpisode:
+    def __init__(self, series, id, title, airdate):
+        self.series = series
+        self.id = id
+        self.title = title
+        self.title_romanji = None
+        self.airdate = airdate
+
+
+def day(n):
+    return datetime(2019, 1, 1, tzinfo=UTC) + timedelta(days=n)
+
+
+@pytest.fixture
+def franchise():
+    return [
+        FakeSeries(1, [(1, 'To You, 2000 Years From Now', day(0)), (2, 'That Day', day(7)), (3, 'Unaired', None)]),
+        FakeSeries(2, [(1, 'Beast Titan', day(14)), (2, "Reiner's Choice", day(21))]),
+    ]
+
+
+def test_airdate_index(franchise):
+    index = AirdateIndex()
+    for series in franchise:
+        index.add(series)
+    assert len(index) == 4
+    assert [ep.id for ep in index.near(day(14))] == [1]
+    assert index.near(day(14))[0].series.id == 2
+    assert index.near(day(10)) == []
+
+
+def test_airdate_index_closest_first(franchise):
+    index = AirdateIndex()
+    index.add(franchise[0])
+    found = index.near(day(7) + timedelta(hours=2), window=timedelta(days=8))
+    assert [ep.id for ep in found] == [2, 1]
+
+
+def test_airdate_index_adds_series_once(franchise):
+    index = AirdateIndex()
+    index.add(franchise[0])
+    index.add(franchise[0])
+    assert len(index) == 2
+    assert franchise[0] in index
+    assert franchise[1] not in index
+
+
+def test_normalize_title():
+    assert normalize_title("  Reiner's  Choice!! ") == 'reiner s choice'
+
+
+def test_title_index_exact(franchise):
+    index = TitleIndex()
+    for series in franchise:
+        index.add(series)
+    episode, score = index.match('that day')
+    assert (episode.series.id, episode.id, score) == (1, 2, 1.0)
+
+
+def test_title_index_fuzzy(franchise):
+    index = TitleIndex()
+    for series in franchise:
+        index.add(series)
+    episode, score = index.match('To You, 2,000 Years From Now')
+    assert (episode.series.id, episode.id) == (1, 1)
+    assert 0.6 < score < 1.0
+    assert index.match('Something else entirely', threshold=0.6) == (None, 0.0)
+
+
+def test_airdate_index_lookups_dont_wait_for_episodes(franchise):
+    index = AirdateIndex()
+    index.add(franchise[1])
+    loading, release = threading.Event(), threading.Event()
+
+    class SlowSeries(FakeSeries):
+        @property
+        def episodes(self):
+            loading.set()
+            release.wait(5)
+            return []
+
+        @episodes.setter
+        def episodes(self, episodes):
+            pass
+
+    adding = threading.Thread(target=index.add, args=(SlowSeries(3, []),))
+    adding.start()
+    loading.wait(5)
+    # answered while the slow series is still loading its episodes
+    found = []
+    lookup = threading.Thread(target=lambda: found.extend(index.near(day(14))))
+    lookup.start()
+    lookup.join(1)
+    release.set()
+    assert [ep.id for ep in found] == [1]
+    adding.join()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+from mal_automaton.__main__ import expand, iter_webhooks, run
+
+webhooks = Path(__file__).parent.parent / 'examples' / 'webhooks'
+
+
+@pytest.fixture(autouse=True)
+def matches(monkeypatch):
+    """ Matches every show except Vinland Saga, without going out to the network. """
+    def tvdb_to_mal(webhook):
+        if webhook.media.series == 'Vinland Saga':
+            return None
+        return {'mal_id': 1, 'episode': webhook.media.episode}
+    monkeypatch.setattr('mal_automaton.__main__.tvdb_to_mal', tvdb_to_mal)
+
+
+@pytest.fixture
+def sources(tmp_path):
+    folder = tmp_path / 'folder'
+    folder.mkdir()
+    shutil.copy(webhooks / '7ds.json', folder)
+    shutil.copy(webhooks / 'sao.json', folder)
+    (folder / 'notes.txt').write_text('not a webhook')
+
+    globbed = tmp_path / 'globbed'
+    globbed.mkdir()
+    shutil.copy(webhooks / 'vinland.json', globbed)
+    (globbed / 'broken.json').write_text('{"event": ')
+
+    lines = [(webhooks / 'jojo.json').read_text().replace('\n', ''), '', 'garbage',
+             (webhooks / '7ds.json').read_text().replace('\n', '')]
+    (tmp_path / 'more.jsonl').write_text('\n'.join(lines) + '\n')
+    return [str(folder), str(globbed / '*.json'), str(tmp_path / 'more.jsonl'), str(tmp_path / 'missing.json')]
+
+
+def test_expand(sources):
+    folder, globbed, jsonl, missing = sources
+    assert [path.name for path in expand(folder)] == ['7ds.json', 'sao.json']
+    assert [path.name for path in expand(globbed)] == ['broken.json', 'vinland.json']
+    assert expand(missing) == [Path(missing)]
+
+
+def test_iter_webhooks(sources):
+    found = list(iter_webhooks(sources))
+    names = [source.rsplit('/', 1)[1] for source, payload in found]
+    assert names == ['7ds.json', 'sao.json', 'broken.json', 'vinland.json',
+                     'more.jsonl:1', 'more.jsonl:3', 'more.jsonl:4', 'missing.json']
+    failed = [name for name, (source, payload) in zip(names, found) if isinstance(payload, Exception)]
+    assert failed == ['broken.json', 'more.jsonl:3', 'missing.json']
+
+
+def test_errors_dont_stop_the_run(sources):
+    records, summary = run(sources)
+    assert len(records) == 8
+    assert (summary['matched'], summary['unmatched'], summary['errors']) == (4, 1, 3)
+    # webhooks for the same show are processed together
+    sins = [i for i, record in enumerate(records) if record['show'] == 'The Seven Deadly Sins']
+    assert sins == [sins[0], sins[0] + 1]
+
+
+def test_results_and_summary_files(sources, tmp_path):
+    output = tmp_path / 'results.jsonl'
+    records, summary = run(sources, jobs=3, output=output)
+
+    written = [json.loads(line) for line in output.read_text().splitlines()]
+    assert written == records
+    errors = {record['source'].rsplit('/', 1)[1]: record['error'] for record in written if record['error']}
+    assert sorted(errors) == ['broken.json', 'missing.json', 'more.jsonl:3']
+    assert errors['missing.json'].startswith('FileNotFoundError')
+    vinland = next(record for record in written if record['show'] == 'Vinland Saga')
+    assert (vinland['result'], vinland['error']) == (None, None)
+
+    saved = json.loads((tmp_path / 'results.jsonl.summary.json').read_text())
+    assert saved == summary
+    assert saved['webhooks'] == 8
+    assert saved['latency_max'] >= saved['latency_p50']
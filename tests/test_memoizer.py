@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import gc
+import pytest
+import mal_automaton.memoizer
+from mal_automaton.memoizer import memento_factory
+
+
+def IDFactory(cls, id):
+    return id
+
+
+Memoizer = memento_factory('Memoizer', IDFactory, use_key=True, maxsize=2)
+ShortLivedMemoizer = memento_factory('ShortLivedMemoizer', IDFactory, use_key=True, ttl=-1)
+
+
+class Thing(object, metaclass=Memoizer):
+    def __init__(self, id):
+        self.id = id
+
+
+class ShortLived(object, metaclass=ShortLivedMemoizer):
+    def __init__(self, id):
+        self.id = id
+
+
+@pytest.fixture(autouse=True)
+def BlankMemoCache():
+    mal_automaton.memoizer._memento_cache = {}
+    Memoizer.stats.clear()
+
+
+def test_same_id_same_object():
+    assert Thing(1) is Thing(1)
+    assert Memoizer.stats['hits'] == 1
+    assert Memoizer.stats['misses'] == 1
+
+
+def test_lru_eviction():
+    Thing(1)
+    Thing(2)
+    Thing(3)
+    gc.collect()
+    assert Memoizer.stats['evictions'] == 1
+    assert len(mal_automaton.memoizer._memento_cache[Thing]) == 2
+    assert 1 not in mal_automaton.memoizer._memento_cache[Thing]
+
+
+def test_evicted_but_referenced():
+    first = Thing(1)
+    Thing(2)
+    Thing(3)
+    assert Memoizer.stats['evictions'] == 1
+    assert Thing(1) is first
+
+
+def test_ttl():
+    assert ShortLived(1) is not ShortLived(1)
+    assert ShortLivedMemoizer.stats['expirations'] >= 1
+
+
+def test_invalidate():
+    first = Thing(1)
+    Thing.invalidate(1)
+    assert Thing(1) is not first
+
+
+def test_single_flight():
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    import time
+
+    built = []
+    SlowMemoizer = memento_factory('SlowMemoizer', IDFactory, use_key=True)
+
+    class Slow(object, metaclass=SlowMemoizer):
+        def __init__(self, id):
+            built.append(threading.get_ident())
+            time.sleep(0.1)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(Slow, [1] * 4))
+    assert len(built) == 1
+    assert all(i is results[0] for i in results)
+
+
+def test_single_flight_failure_not_cached():
+    attempts = []
+    FailingMemoizer = memento_factory('FailingMemoizer', IDFactory, use_key=True)
+
+    class Failing(object, metaclass=FailingMemoizer):
+        def __init__(self, id):
+            attempts.append(id)
+            if len(attempts) == 1:
+                raise ValueError('upstream failure')
+
+    with pytest.raises(ValueError):
+        Failing(1)
+    assert Failing(1)
+    assert len(attempts) == 2
+
+
+class SlottedThing(object, metaclass=Memoizer):
+    __slots__ = ('id', '__weakref__')
+
+    def __init__(self, id):
+        self.id = id
+
+
+def test_slotted_objects_are_kept_while_referenced():
+    first = SlottedThing(1)
+    SlottedThing(2)
+    SlottedThing(3)
+    # evicted, but still alive, so the same object comes back
+    assert SlottedThing(1) is first
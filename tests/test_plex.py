@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import json
+import pytest
+from pathlib import Path
+from mal_automaton.plex import PlexWebhook, WebhookFilter
+from mal_automaton.utils import AttrView, loads
+
+
+webhooks = Path(__file__).parent.parent / 'examples' / 'webhooks'
+
+
+def load(name):
+    return json.load((webhooks / name).open())
+
+
+def test_filter_ignores_other_events():
+    webhook_filter = WebhookFilter(events=['media.scrobble'])
+    assert not webhook_filter(load('jojo.json'))
+    assert webhook_filter.stats['ignored'] == 1
+
+
+def test_filter_coalesces_repeats():
+    webhook_filter = WebhookFilter(events=['media.play'], window=60)
+    payload = load('jojo.json')
+    assert webhook_filter(payload)
+    assert not webhook_filter(payload)
+    assert webhook_filter(load('sao.json'))
+    assert webhook_filter.stats['coalesced'] == 1
+
+
+def test_filter_window_expires():
+    webhook_filter = WebhookFilter(events=['media.play'], window=0)
+    payload = load('jojo.json')
+    assert webhook_filter(payload)
+    assert webhook_filter(payload)
+
+
+def test_webhook_parsing_is_lazy():
+    webhook = PlexWebhook(load('jojo.json'))
+    assert webhook.media.tvdb_id == 262954
+    assert (webhook.media.season, webhook.media.episode) == (4, 11)
+    assert webhook.media._tvdb is None
+
+
+def test_attr_view_wraps_on_access():
+    payload = {'Metadata': {'title': 'A', 'Genre': [{'tag': 'Action'}]}, 'event': 'media.play'}
+    view = AttrView(payload)
+    assert view.event == 'media.play'
+    assert view.Metadata.title == 'A'
+    assert view.Metadata.Genre[0].tag == 'Action'
+    # it's a view, so nothing was copied
+    assert view.Metadata._data is payload['Metadata']
+    with pytest.raises(AttributeError):
+        view.missing
+
+
+def test_loads_accepts_bytes():
+    raw = (webhooks / 'sao.json').read_bytes()
+    assert loads(raw) == json.loads(raw)
+    with pytest.raises(ValueError):
+        loads(b'{not json')
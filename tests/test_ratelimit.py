@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import pytest
+import requests
+from jikanpy.exceptions import APIException
+from mal_automaton.ratelimit import TokenBucket, RetryBudget, Upstream, retry_after
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr('mal_automaton.ratelimit.time.sleep', slept.append)
+    return slept
+
+
+def test_token_bucket_allows_burst_then_paces():
+    bucket = TokenBucket(rate=2, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.5, abs=0.01)
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.01)
+
+
+def test_token_bucket_pause():
+    bucket = TokenBucket(rate=100, burst=10)
+    bucket.pause(5)
+    assert bucket.reserve() == pytest.approx(5, abs=0.01)
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, reserve=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_retry_after():
+    assert retry_after(FakeResponse(429, {'Retry-After': '3'})) == 3
+    assert retry_after(FakeResponse(429)) is None
+
+
+def test_retries_failures(sleeps):
+    upstream = Upstream('test', rate=1000, burst=10, tries=3, backoff=1)
+    responses = iter([APIException(503), FakeResponse(429, {'Retry-After': '7'}), FakeResponse(200)])
+
+    def request():
+        response = next(responses)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert upstream.call(request).status_code == 200
+    # two backoffs, then the limiter holds the last attempt back for the Retry-After
+    assert len(sleeps) == 3
+    assert sleeps[0] <= 1
+    assert sleeps[2] == pytest.approx(7, abs=0.1)
+
+
+def test_gives_up(sleeps):
+    upstream = Upstream('test', rate=1000, burst=10, tries=2)
+
+    def request():
+        raise requests.ConnectionError()
+
+    with pytest.raises(requests.ConnectionError):
+        upstream.call(request)
+    assert len(sleeps) == 1
+
+
+def test_does_not_retry_client_errors(sleeps):
+    upstream = Upstream('test', rate=1000, burst=10, tries=3)
+    assert upstream.call(lambda: FakeResponse(404)).status_code == 404
+
+    def request():
+        raise APIException(404)
+
+    with pytest.raises(APIException):
+        upstream.call(request)
+    assert sleeps == []
+
+
+def test_unsafe_requests_only_retry_when_turned_away(sleeps):
+    upstream = Upstream('test', rate=1000, burst=10, tries=3)
+    responses = iter([FakeResponse(429), FakeResponse(503), FakeResponse(200)])
+    assert upstream.call(lambda: next(responses), idempotent=False).status_code == 503
+
+    def request():
+        raise requests.ConnectionError()
+
+    with pytest.raises(requests.ConnectionError):
+        upstream.call(request, idempotent=False)
+    assert len(sleeps) == 1
+
+
+def test_jikan_errors_fall_back_to_backoff(sleeps):
+    upstream = Upstream('test', rate=1000, burst=10, tries=2, backoff=1)
+    errors = iter([APIException(429)])
+
+    def request():
+        for error in errors:
+            raise error
+        return FakeResponse(200)
+
+    assert retry_after(APIException(429)) is None
+    assert upstream.call(request).status_code == 200
+    assert len(sleeps) == 1 and sleeps[0] <= 1
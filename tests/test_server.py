@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import pytest
+from concurrent.futures import Future
+
+pytest.importorskip('flask')
+from mal_automaton.account import ConfigurationError  # noqa: E402
+from mal_automaton.durable_queue import DurableQueue  # noqa: E402
+from mal_automaton.server import WebhookProcessor, create_app  # noqa: E402
+
+
+def test_processor_drains_queue():
+    handled = []
+    processor = WebhookProcessor(handled.append, DurableQueue(':memory:'), workers=2)
+    processor.start()
+    for i in range(5):
+        assert processor.submit({'n': i})
+    while processor.depth:
+        time.sleep(0.01)
+    processor.stop()
+    assert sorted(p['n'] for p in handled) == list(range(5))
+    assert processor.status()['processed'] == 5
+
+
+def test_processor_retries_failures():
+    def handler(payload):
+        raise ValueError('upstream is down')
+
+    webhooks = DurableQueue(':memory:', retry_delay=60)
+    processor = WebhookProcessor(handler, webhooks, workers=1)
+    processor.start()
+    processor.submit({})
+    while not processor.status()['failed']:
+        time.sleep(0.01)
+    processor.stop()
+    assert processor.depth == 1
+
+
+def test_processor_gives_up_on_configuration_errors():
+    calls = []
+
+    def handler(payload):
+        calls.append(payload)
+        raise ConfigurationError('No password configured for MAL account someone.')
+
+    processor = WebhookProcessor(handler, DurableQueue(':memory:', retry_delay=0), workers=1)
+    processor.start()
+    processor.submit({})
+    while processor.depth:
+        time.sleep(0.01)
+    processor.stop()
+    assert len(calls) == 1
+    assert (processor.status()['failed'], processor.status()['given_up']) == (1, 1)
+
+
+def test_processor_waits_for_batched_updates():
+    updates = []
+
+    def handler(payload):
+        updates.append(Future())
+        return updates[-1]
+
+    webhooks = DurableQueue(':memory:', retry_delay=60)
+    processor = WebhookProcessor(handler, webhooks, workers=1)
+    processor.start()
+    processor.submit({'n': 1})
+    processor.submit({'n': 2})
+    while len(updates) < 2:
+        time.sleep(0.01)
+    # both still claimed until MAL has the updates
+    assert processor.depth == 2
+    updates[0].set_result(True)
+    updates[1].set_result(False)
+    processor.stop()
+    status = processor.status()
+    assert (status['processed'], status['failed'], status['depth']) == (1, 1, 1)
+
+
+def test_ingest_acknowledges_immediately():
+    processor = WebhookProcessor(lambda payload: None, DurableQueue(':memory:', max_depth=1))
+    client = create_app(processor).test_client()
+
+    def webhook(guid, event='media.scrobble'):
+        return {'payload': json.dumps({'event': event, 'Metadata': {'guid': guid}})}
+
+    assert client.post('/', data=webhook('a')).status_code == 200
+    assert processor.depth == 1
+    assert client.post('/', data=webhook('b')).status_code == 503
+    assert client.post('/', data=webhook('a')).status_code == 200
+    assert client.post('/', data=webhook('c', 'media.pause')).status_code == 200
+    assert client.post('/', data={}).status_code == 400
+    status = client.get('/status').get_json()
+    assert (status['received'], status['dropped'], status['depth']) == (2, 1, 1)
+    assert (status['coalesced'], status['ignored']) == (1, 1)
+
+
+def test_rejected_webhook_is_accepted_when_resent():
+    webhooks = DurableQueue(':memory:', max_depth=1)
+    client = create_app(WebhookProcessor(lambda payload: None, webhooks)).test_client()
+
+    def webhook(guid):
+        return {'payload': json.dumps({'event': 'media.scrobble', 'Metadata': {'guid': guid}})}
+
+    assert client.post('/', data=webhook('a')).status_code == 200
+    assert client.post('/', data=webhook('b')).status_code == 503
+    id, payload = webhooks.get(timeout=0)
+    webhooks.done(id)
+    assert client.post('/', data=webhook('b')).status_code == 200
+    assert webhooks.depth == 1
+    assert client.get('/status').get_json()['coalesced'] == 0
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import json
+import pytest
+from pathlib import Path
+from mal_automaton import translate
+from mal_automaton.cache import Cache
+from mal_automaton.plex import PlexWebhook
+
+
+webhooks = Path(__file__).parent.parent / 'examples' / 'webhooks'
+
+
+class FakeFranchise:
+    def __init__(self, name=None, id=1, fingerprint=None):
+        self.id = id
+        self.fingerprint = fingerprint or [[1, 'Finished Airing']]
+
+
+def load(name, **metadata):
+    payload = json.load((webhooks / name).open())
+    payload['Metadata'].update(metadata)
+    return payload
+
+
+@pytest.fixture(autouse=True)
+def caches(monkeypatch):
+    """ Every cache translate uses, in memory, so matches from other tests (and runs) don't leak in. """
+    caches = {}
+
+    def get_cache(table):
+        if table not in caches:
+            caches[table] = Cache(':memory:', table)
+        return caches[table]
+    monkeypatch.setattr(translate, 'get_cache', get_cache)
+    return caches
+
+
+def no_franchise(*args, **kwargs):
+    raise AssertionError('went out to MAL')
+
+
+def no_tvdb(*args, **kwargs):
+    raise AssertionError('went out to TVDB')
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    """ Fails the test if anything tries to look a series up on MAL or TVDB. """
+    monkeypatch.setattr(translate, 'MAL_Franchise', no_franchise)
+    monkeypatch.setattr('mal_automaton.plex.TVDB_Series', no_tvdb)
+
+
+def test_movies_are_skipped(offline):
+    movie = PlexWebhook(load('sao.json', librarySectionType='movie', type='movie',
+                             title='Sword Art Online: Ordinal Scale'))
+    assert translate.tvdb_to_mal(movie) is False
+
+
+def test_stored_match_is_used(monkeypatch):
+    result = {'mal_id': 36474, 'episode': 7, 'score': 1.0}
+    monkeypatch.setattr(translate, 'MAL_Franchise', FakeFranchise)
+    monkeypatch.setattr(translate, 'match_episode', lambda franchise, media: result)
+    assert translate.tvdb_to_mal(PlexWebhook(load('sao.json'))) == result
+
+    # later webhooks for the same episode don't even look the franchise up
+    monkeypatch.setattr(translate, 'MAL_Franchise', no_franchise)
+    assert translate.tvdb_to_mal(PlexWebhook(load('sao.json'))) == result
+
+
+def test_stored_match_is_ignored_once_the_franchise_changes():
+    media = PlexWebhook(load('sao.json')).media
+    result = {'mal_id': 36474, 'episode': 7, 'score': 1.0}
+    franchise = FakeFranchise()
+    translate.remember_franchise(franchise)
+    translate.store_mapping(media, franchise, result)
+    assert translate.cached_mapping(media) == result
+
+    # e.g. a new season was added to the franchise
+    translate.remember_franchise(FakeFranchise(fingerprint=[[1, 'Finished Airing'], [2, 'Not yet aired']]))
+    assert translate.cached_mapping(media) is None
+
+
+def test_match_clears_misses(caches):
+    media = PlexWebhook(load('sao.json')).media
+    translate.store_miss(media)
+    counter = translate.cache_key('count', 'tvdb', media.tvdb_id)
+    assert caches['misses'].get(counter) == 1
+
+    translate.store_mapping(media, FakeFranchise(), {'mal_id': 36474, 'episode': 7, 'score': 1.0})
+    assert caches['misses'].get(counter) is None
+
+
+@pytest.mark.parametrize('allowed, denied, processed', [
+    ([], [], True),
+    (['Anime'], [], True),
+    (['Anime Movies'], [], False),
+    ([], ['Anime'], False),
+    (['Anime'], ['Anime'], False),
+])
+def test_library_allowed(monkeypatch, allowed, denied, processed):
+    monkeypatch.setattr(translate, 'ALLOWED_LIBRARIES', allowed)
+    monkeypatch.setattr(translate, 'DENIED_LIBRARIES', denied)
+    assert translate.library_allowed(PlexWebhook(load('sao.json')).media) is processed
+
+
+def test_denied_library_is_skipped(monkeypatch, offline, caches):
+    monkeypatch.setattr(translate, 'DENIED_LIBRARIES', ['Anime'])
+    assert translate.tvdb_to_mal(PlexWebhook(load('sao.json'))) is False
+    # and it isn't remembered as a miss either, in case the library is processed later
+    assert len(caches.get('misses', [])) == 0
+
+
+def test_empty_search_is_a_miss(monkeypatch):
+    def franchise(name):
+        raise IndexError(name)
+    monkeypatch.setattr(translate, 'MAL_Franchise', franchise)
+    assert translate.tvdb_to_mal(PlexWebhook(load('sao.json'))) is False
+    assert translate.cached_miss(PlexWebhook(load('sao.json')).media)
+
+    # the next webhook for it doesn't search again
+    monkeypatch.setattr(translate, 'MAL_Franchise', no_franchise)
+    assert translate.tvdb_to_mal(PlexWebhook(load('sao.json'))) is False
+
+
+def test_series_is_skipped_after_enough_misses(monkeypatch):
+    monkeypatch.setattr(translate, 'NEGATIVE_SERIES_THRESHOLD', 3)
+    for episode in range(1, 3):
+        translate.store_miss(PlexWebhook(load('sao.json', index=episode)).media)
+    # an episode that hasn't been tried yet is still worth a try...
+    assert not translate.cached_miss(PlexWebhook(load('sao.json', index=7)).media)
+
+    translate.store_miss(PlexWebhook(load('sao.json', index=3)).media)
+    # ...but not once enough of them have missed
+    assert translate.cached_miss(PlexWebhook(load('sao.json', index=7)).media)
+    assert not translate.cached_miss(PlexWebhook(load('jojo.json')).media)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import pytest
+from mal_automaton.cache import Cache
+from mal_automaton.enums import WatchStatus
+from mal_automaton.write_behind import WriteBehind, merge
+
+
+class FakeSession:
+    username = 'someone'
+
+    def __init__(self):
+        self.calls = []
+        self.ok = True
+
+    def add_series(self, mal_id, status, score, watched_episodes):
+        self.calls.append(('add', mal_id, status, watched_episodes))
+        return self.ok
+
+    def edit_series(self, mal_id, status, score, watched_episodes):
+        self.calls.append(('edit', mal_id, status, watched_episodes))
+        return self.ok
+
+    def delete_series(self, mal_id):
+        self.calls.append(('delete', mal_id))
+        return self.ok
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return Cache(tmp_path / 'journal.db', 'pending_writes', max_entries=None)
+
+
+@pytest.fixture
+def session():
+    return FakeSession()
+
+
+def test_coalesces_per_series(session, journal):
+    writes = WriteBehind(session, journal, max_pending=10)
+    for episode in range(1, 13):
+        writes.edit_series(1, WatchStatus.Watching, 0, episode)
+    writes.add_series(2, WatchStatus.Watching, 0, 1)
+    writes.edit_series(2, WatchStatus.Watching, 0, 2)
+    assert writes.stats['coalesced'] == 12
+    assert writes.flush() == {1: True, 2: True}
+    assert sorted(session.calls) == [('add', 2, WatchStatus.Watching, 2), ('edit', 1, WatchStatus.Watching, 12)]
+    assert len(journal) == 0
+
+
+def test_merge():
+    add = {'action': 'add', 'status': 1}
+    edit = {'action': 'edit', 'status': 2}
+    delete = {'action': 'delete', 'status': None}
+    assert merge(add, delete) is None
+    assert merge(delete, add)['action'] == 'edit'
+    assert merge(edit, delete) is delete
+
+
+def test_journal_survives_restart(session, journal):
+    WriteBehind(session, journal).edit_series(1, WatchStatus.Completed, 8, 24)
+    writes = WriteBehind(session, journal)
+    assert writes.flush() == {1: True}
+    assert session.calls == [('edit', 1, WatchStatus.Completed, 24)]
+
+
+def test_failed_writes_are_retried(session, journal):
+    writes = WriteBehind(session, journal, max_attempts=2)
+    writes.edit_series(1, WatchStatus.Watching, 0, 3)
+    session.ok = False
+    assert writes.flush() == {1: False}
+    assert len(writes) == 1
+    assert writes.flush() == {1: False}
+    assert len(writes) == 0
+    assert writes.stats['given_up'] == 1
+
+
+def test_flushes_at_threshold(session, journal):
+    results = []
+    writes = WriteBehind(session, journal, interval=60, max_pending=2, on_flush=results.append)
+    writes.start()
+    first = writes.edit_series(1, WatchStatus.Watching, 0, 3)
+    writes.edit_series(2, WatchStatus.Watching, 0, 3)
+    # well before the interval is up
+    assert first.result(timeout=5) is True
+    assert writes.close() == {}
+    assert results == [{1: True, 2: True}]
+
+
+def test_futures_follow_the_writes(session, journal):
+    settled = []
+    writes = WriteBehind(session, journal, max_attempts=2,
+                         on_settle=lambda mal_id, write, written: settled.append((mal_id, written)))
+    earlier = writes.edit_series(1, WatchStatus.Watching, 0, 3)
+    later = writes.edit_series(1, WatchStatus.Watching, 0, 4)
+    session.ok = False
+    writes.flush()
+    assert not earlier.done() and not later.done()
+    writes.flush()
+    assert (earlier.result(0), later.result(0)) == (False, False)
+    assert settled == [(1, False)]
+
+    session.ok = True
+    sent = writes.edit_series(2, WatchStatus.Watching, 0, 1)
+    writes.flush()
+    assert sent.result(0) is True
+    assert settled[-1] == (2, True)
+
+
+def test_close_tells_waiters_about_unsent_writes(session, journal):
+    writes = WriteBehind(session, journal)
+    session.ok = False
+    pending = writes.edit_series(1, WatchStatus.Watching, 0, 3)
+    assert writes.close() == {1: False}
+    assert pending.result(0) is False
+    # still journaled for the next run
+    assert len(WriteBehind(session, journal)) == 1
+
+
+def test_failed_add_cancelled_out_by_a_later_delete(session, journal):
+    settled = []
+    writes = WriteBehind(session, journal, on_settle=lambda mal_id, write, written: settled.append((mal_id, written)))
+    added = writes.add_series(1, WatchStatus.Watching, 0, 1)
+    deleted = []
+
+    def add_series(*args):
+        # the series is taken off the list again while the add is on its way
+        deleted.append(writes.delete_series(1))
+        return False
+    session.add_series = add_series
+
+    assert writes.flush() == {1: False}
+    assert (added.result(0), deleted[0].result(0)) == (True, True)
+    assert settled == [(1, True)]
+    assert len(writes) == 0 and len(journal) == 0
+    assert writes.flush() == {}
+
+
+def test_writes_that_cancel_out_are_settled(session, journal):
+    settled = []
+    writes = WriteBehind(session, journal, on_settle=lambda mal_id, write, written: settled.append((mal_id, written)))
+    added = writes.add_series(1, WatchStatus.Watching, 0, 1)
+    deleted = writes.delete_series(1)
+    assert (added.result(0), deleted.result(0)) == (True, True)
+    assert settled == [(1, True)]
+    assert writes.flush() == {}
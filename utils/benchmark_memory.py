@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Measure how much memory each cached episode (and list entry) takes, using
+tracemalloc. The payloads are made up, but shaped like the real Jikan and
+TVDB records, so no API keys or network access are needed.
+
+"before" is the same class without __slots__ (and for TVDB episodes, holding
+on to the raw record, like it used to), built out of parts without __slots__
+too (e.g. the AnimeStatus of a list entry); "after" is the model as it is now.
+Run it from the top of the repository:
+
+    $ python3 -m utils.benchmark_memory --count 10000
+"""
+
+# builtins
+import argparse
+import tracemalloc
+from contextlib import nullcontext
+from unittest import mock
+
+# my modules
+from mal_automaton import animelist
+from mal_automaton.animelist import AnimeListEntry, AnimeStatus
+from mal_automaton.mal import MAL_Episode
+from mal_automaton.tvdb import TVDB_Episode
+
+
+class FakeSeries(object):
+    id = 1
+    title = 'Benchmark'
+
+
+def mal_episode(n):
+    return (FakeSeries, {
+        'episode_id': n,
+        'title': f'Episode title number {n}',
+        'title_japanese': 'エピソード',
+        'title_romanji': f'Episode romanji number {n}',
+        'aired': '2019-04-29T00:00:00+00:00',
+        'filler': False,
+        'recap': False,
+        'video_url': f'https://myanimelist.net/anime/1/Benchmark/episode/{n}',
+        'forum_url': f'https://myanimelist.net/forum/?topicid={n}',
+    })
+
+
+def tvdb_episode(n):
+    return (FakeSeries, None, {
+        'id': n,
+        'airedSeason': 1,
+        'airedSeasonID': 1,
+        'airedEpisodeNumber': n,
+        'absoluteNumber': n,
+        'episodeName': f'Episode title number {n}',
+        'firstAired': '2019-04-28',
+        'overview': 'Something happens in this episode, and then something else happens too. ' * 3,
+        'language': {'episodeName': 'en', 'overview': 'en'},
+        'dvdSeason': None,
+        'dvdEpisodeNumber': None,
+        'lastUpdated': 1556400000,
+    })
+
+
+def list_entry(n):
+    return ({
+        'mal_id': n,
+        'title': f'Series number {n}',
+        'type': 'TV',
+        'airing_status': 2,
+        'total_episodes': 12,
+        'watching_status': 1,
+        'score': 0,
+        'watched_episodes': 3,
+        'image_url': f'https://cdn.myanimelist.net/images/anime/{n}.jpg',
+        'url': f'https://myanimelist.net/anime/{n}',
+        'tags': None,
+        'studios': [{'mal_id': 1, 'name': 'Studio'}],
+    },)
+
+
+def unslotted(cls, kept_raw):
+    """ The same class the way the models used to be: a __dict__ per object, and maybe the raw record kept. """
+    def __init__(self, *args, **kwargs):
+        cls.__init__(self, *args, **kwargs)
+        if kept_raw:
+            self._raw = args[-1]
+    slots = set(cls.__slots__) | {'__slots__', '__dict__', '__weakref__'}
+    namespace = {name: value for name, value in vars(cls).items() if name not in slots}
+    namespace['__init__'] = __init__
+    return type(f'{cls.__name__}Before', (object,), namespace)
+
+
+def measure(build, payload, count):
+    """ Bytes per object, for `count` objects built from fresh payloads (as if they'd just been decoded). """
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    objects = [build(*payload(n)) for n in range(1, count + 1)]
+    used = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(start, 'filename'))
+    tracemalloc.stop()
+    del objects
+    return used / count
+
+
+def construct(cls):
+    """ Build objects without going through the memoizer, so only the objects themselves are measured. """
+    def build(*args):
+        obj = cls.__new__(cls)
+        cls.__init__(obj, *args)
+        return obj
+    return build
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n',
+        '--count',
+        help='Number of objects of each kind to build',
+        type=int,
+        default=10000,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    print(f'{"":<16}{"before":>12}{"after":>12}')
+    # the model, its payload, whether it used to keep the raw record, and the slotted classes it's built out of
+    models = (
+        (MAL_Episode, mal_episode, False, {}),
+        (TVDB_Episode, tvdb_episode, True, {}),
+        (AnimeListEntry, list_entry, False, {'AnimeStatus': unslotted(AnimeStatus, False)}),
+    )
+    for cls, payload, kept_raw, parts in models:
+        with mock.patch.multiple(animelist, **parts) if parts else nullcontext():
+            before = measure(construct(unslotted(cls, kept_raw)), payload, args.count)
+        after = measure(construct(cls), payload, args.count)
+        print(f'{cls.__name__:<16}{before:>10.0f} B{after:>10.0f} B')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+Time how long it takes to go from a raw webhook payload to a PlexWebhook,
+over the recorded webhooks in examples/webhooks. "before" decodes with the
+json module and eagerly copies the whole payload into attribute objects,
+like PlexWebhook used to; "after" is the current path. Run it from the top
+of the repository:
+
+    $ python3 -m utils.benchmark_webhooks --repeat 2000
+"""
+
+# builtins
+import argparse
+import json
+import timeit
+from pathlib import Path
+from unittest import mock
+
+# my modules
+from mal_automaton import plex, utils
+from mal_automaton.plex import PlexWebhook
+
+
+webhooks = Path(__file__).parent.parent / 'examples' / 'webhooks'
+
+
+class EagerAttrDict(object):
+    """ How webhooks used to be converted: the whole payload, recursively, up front. """
+    def __init__(self, _dict):
+        for key, value in _dict.items():
+            if isinstance(value, dict):
+                self.__dict__.update({key: EagerAttrDict(value)})
+            elif isinstance(value, list):
+                self.__dict__.update({key: [EagerAttrDict(i) for i in value]})
+            else:
+                self.__dict__.update({key: value})
+
+
+def parse_before(raw):
+    # only used while plex.AttrView is patched to EagerAttrDict, see main()
+    return PlexWebhook(json.loads(raw))
+
+
+def parse_after(raw):
+    return PlexWebhook(utils.loads(raw))
+
+
+def bench(func, payloads, repeat):
+    """ Microseconds per webhook. """
+    seconds = timeit.timeit(lambda: [func(raw) for raw in payloads], number=repeat)
+    return seconds / (repeat * len(payloads)) * 1e6
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        help='Number of times to parse every webhook',
+        type=int,
+        default=1000,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    payloads = [path.read_bytes() for path in sorted(webhooks.glob('*.json'))]
+    decoder = utils.fast_json.__name__ if utils.fast_json else 'json'
+    print(f'{len(payloads)} webhooks, {args.repeat} times each (fast decoder: {decoder})')
+    print(f'{"":<12}{"before":>12}{"after":>12}')
+    decode = (bench(json.loads, payloads, args.repeat), bench(utils.loads, payloads, args.repeat))
+    with mock.patch.object(plex, 'AttrView', EagerAttrDict):
+        before = bench(parse_before, payloads, args.repeat)
+    parse = (before, bench(parse_after, payloads, args.repeat))
+    for name, (before, after) in (('decode', decode), ('parse', parse)):
+        print(f'{name:<12}{before:>9.1f} µs{after:>9.1f} µs')
+
+
+if __name__ == "__main__":
+    main()